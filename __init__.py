@@ -1,37 +1,54 @@
-from typing import Union
+from typing import Optional, Union
 
+from .batch import BatchResult, render_charts
+from .cache import MemoryCache, SQLiteCache
+from .executor import RenderExecutor, RenderQueueFullError
+from .metrics import LoggingSink, PrometheusSink, StageMetrics
 from .model import DifficultyInt
-from .render import Render
-from .resource import (
-    get_chart_official,
-    get_chart_user_post,
-    get_song_jacket_url_official,
-    get_song_jacket,
-    get_song_official,
-    generate_song_meta_official,
-    generate_song_meta_user_post
-)
-
-
-async def render_chart_official(song_id: int, difficulty: Union[DifficultyInt, int]) -> Render:
-    chart = await get_chart_official(song_id, difficulty)
-    song = await get_song_official(song_id)
-    jacket = await get_song_jacket(get_song_jacket_url_official(song_id, song.jacketImage[0]))
-    meta = await generate_song_meta_official(song, song_id, difficulty)
-
+from .render import CanvasTooLargeError, Render
+from .render_cache import RenderCache
+from .resource import get_chart_resources_official, get_chart_resources_user_post, set_cache
+from .utils import startup_client, shutdown_client
+
+
+async def render_chart_official(
+        song_id: int,
+        difficulty: Union[DifficultyInt, int],
+        executor: Optional[RenderExecutor] = None,
+        fast: bool = False
+) -> Render:
+    chart, meta, jacket = await get_chart_resources_official(song_id, difficulty, fast)
+
+    if executor is not None:
+        return await executor.submit(chart, meta, jacket)
     return Render(chart, meta, jacket)
 
 
-async def render_chart_user_post(post_id: int) -> Render:
-    post = (await get_chart_user_post(post_id)).post
-    chart = post.chart
-    jacket = await get_song_jacket(post.song.cover)
-    meta = generate_song_meta_user_post(post, post_id)
+async def render_chart_user_post(post_id: int, executor: Optional[RenderExecutor] = None) -> Render:
+    chart, meta, jacket = await get_chart_resources_user_post(post_id)
 
+    if executor is not None:
+        return await executor.submit(chart, meta, jacket)
     return Render(chart, meta, jacket)
 
 
 __all__ = [
     'render_chart_official',
-    'render_chart_user_post'
+    'render_chart_user_post',
+    'render_charts',
+    'get_chart_resources_official',
+    'get_chart_resources_user_post',
+    'BatchResult',
+    'RenderExecutor',
+    'RenderQueueFullError',
+    'RenderCache',
+    'CanvasTooLargeError',
+    'set_cache',
+    'startup_client',
+    'shutdown_client',
+    'MemoryCache',
+    'SQLiteCache',
+    'StageMetrics',
+    'LoggingSink',
+    'PrometheusSink'
 ]
@@ -0,0 +1,83 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterable, NamedTuple, Optional, Union
+
+from .executor import RenderExecutor
+from .render import Render
+from .resource import get_chart_resources_official, get_chart_resources_user_post
+
+BatchKey = Union[tuple[int, int], int]  # (song_id, difficulty) of an official chart, or post_id of a community chart
+
+
+class BatchResult(NamedTuple):
+    key: BatchKey
+    content: Optional[bytes]  # encoded image, None on error or with return_render
+    render: Optional[Render]  # only with return_render
+    error: Optional[Exception]
+
+
+async def render_charts(
+        keys: Iterable[BatchKey],
+        executor: Optional[RenderExecutor] = None,
+        max_fetches: int = 8,
+        fast: bool = False,
+        format: Optional[str] = None,
+        preset: Optional[str] = None,
+        return_render: bool = False
+) -> AsyncIterator[BatchResult]:
+    """
+    Fetch and render many charts, yielding results as they complete.
+
+    At most max_fetches charts are fetched at once, and rasterization runs in
+    executor, by default a process pool with one worker per core. No more
+    charts are taken from keys than the executor can hold, and a chart that
+    fails to fetch or render is yielded with its error instead of stopping
+    the batch. fast=True skips validation of official charts, see
+    resource.parse_chart_fast.
+
+    Images are encoded in the workers with format and preset, see
+    Render.save, so only the bytes are sent back. return_render=True returns
+    the rasterized Render instead, at the cost of pickling its whole image.
+    """
+    own_executor = executor is None
+    if own_executor:
+        workers = os.cpu_count() or 1
+        executor = RenderExecutor(ProcessPoolExecutor(workers), max_concurrency=workers, max_queue=max_fetches)
+
+    fetching = asyncio.Semaphore(max_fetches)
+
+    async def process(key: BatchKey) -> BatchResult:
+        try:
+            async with fetching:
+                if isinstance(key, tuple):
+                    chart, meta, jacket = await get_chart_resources_official(*key, fast)
+                else:
+                    chart, meta, jacket = await get_chart_resources_user_post(key)
+            if return_render:
+                return BatchResult(key, None, await executor.submit(chart, meta, jacket), None)
+            return BatchResult(key, await executor.submit_bytes(chart, meta, jacket, format, preset), None, None)
+        except Exception as e:  # noqa
+            return BatchResult(key, None, None, e)
+
+    keys = iter(keys)
+    pending: set[asyncio.Future] = set()
+    try:
+        while True:
+            while len(pending) < executor.max_concurrency + executor.max_queue:
+                key = next(keys, None)
+                if key is None:
+                    break
+                pending.add(asyncio.ensure_future(process(key)))
+
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import multiprocessing
+import platform
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Optional, TypeVar, Union
+
+import numpy as np
+import PIL
+from pydantic import parse_obj_as
+
+from .metrics import MetricsSink, StageMetrics
+from .model import Chart, ChartMeta, DifficultyInt
+from .render import Render, renderer_version
+from .resource import (
+    InGameResourceManager as IGRMngr,
+    assets,
+    get_chart_resources_official, get_chart_resources_user_post,
+    parse_chart_fast,
+)
+
+_T = TypeVar('_T')
+benchmark_fixtures = assets / 'benchmark'  # recorded real charts, see record_fixture
+synthetic_cases: dict[str, dict[str, Any]] = {  # name: options of generate_chart
+    'small': {'notes': 200, 'bars': 20, 'bpm_changes': 2, 'slides': 10},
+    'medium': {'notes': 900, 'bars': 60, 'bpm_changes': 6, 'slides': 50},
+    'large': {'notes': 3000, 'bars': 200, 'bpm_changes': 100, 'slides': 200},
+    'dense': {'notes': 3000, 'bars': 40, 'bpm_changes': 2, 'slides': 40, 'directional_widths': (1, 7)},
+    'long': {'notes': 2000, 'bars': 600, 'bpm_changes': 20, 'slides': 100},
+}
+synthetic_meta = ChartMeta(
+    id=0, title='Synthetic', level=28, difficulty=DifficultyInt.Expert, release=datetime.datetime(2020, 1, 1),
+    is_official=True, artist='Benchmark', lyricist='-', composer='-', arranger='-'
+)
+
+
+def generate_chart(
+        notes: int = 1000,
+        bars: int = 60,
+        bpm_changes: int = 4,
+        slides: int = 40,
+        directional_ratio: float = 0.1,
+        directional_widths: tuple[int, int] = (1, 3),
+        seed: int = 0
+) -> list[dict[str, Any]]:
+    """
+    Generate a random chart in the JSON format of bestdori.com, the same for
+    the same arguments.
+
+    notes counts the single and directional notes, directional_ratio of them
+    directional with a width in directional_widths. slides is the count of
+    slide and long notes, each of 2 to 6 connections.
+    """
+    rng = random.Random(seed)
+    max_beat = bars * 4
+
+    def get_beat(start: float = 0, end: float = max_beat) -> float:
+        return round(rng.uniform(start, end) * rng.choice((2, 4, 4, 6))) / 4
+
+    chart: list[dict[str, Any]] = [{'type': 'BPM', 'bpm': 150, 'beat': 0}]
+    chart += sorted(({'type': 'BPM', 'bpm': rng.choice((90, 120, 150, 180, 240)), 'beat': get_beat(1)}
+                     for _ in range(bpm_changes)), key=lambda note: note['beat'])
+    fever_beat = round(max_beat * 0.4)
+    chart += [
+        {'type': 'System', 'data': 'cmd_fever_ready.wav', 'beat': fever_beat},
+        {'type': 'System', 'data': 'cmd_fever_start.wav', 'beat': fever_beat + 8},
+        {'type': 'System', 'data': 'cmd_fever_end.wav', 'beat': fever_beat + 40},
+    ]
+
+    for _ in range(notes):
+        if rng.random() < directional_ratio:
+            chart.append({
+                'type': 'Directional', 'beat': get_beat(), 'lane': rng.randrange(7),
+                'direction': rng.choice(('Left', 'Right')), 'width': rng.randint(*directional_widths)
+            })
+        else:
+            note = {'type': 'Single', 'beat': get_beat(), 'lane': rng.randrange(7)}
+            if rng.random() < 0.15:
+                note['flick'] = True
+            elif rng.random() < 0.02:
+                note['skill'] = True
+            chart.append(note)
+
+    for _ in range(slides):
+        beat = get_beat(0, max_beat - 16)
+        connections = []
+        for i in range(rng.randint(2, 6)):
+            connection = {'lane': rng.randrange(7), 'beat': beat}
+            if 0 < i and rng.random() < 0.2:
+                connection['hidden'] = True
+            connections.append(connection)
+            beat += rng.choice((0.25, 0.5, 1, 2))
+        if rng.random() < 0.3:
+            connections[-1]['flick'] = True
+        chart.append({'type': rng.choice(('Slide', 'Long')), 'connections': connections})
+
+    return chart
+
+
+def get_rss(field: str = 'VmRSS') -> Optional[int]:
+    """Get the resident memory of the process in bytes, VmHWM for its peak, if the platform reports it (Linux only)."""
+    try:
+        status = Path('/proc/self/status').read_text()
+    except OSError:
+        return None
+    for line in status.splitlines():
+        if line.startswith(f'{field}:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of the process to the current one, if the platform allows it (Linux only)."""
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        return False
+    return True
+
+
+def measure(func: Callable[[_T], Any], setup: Callable[[], _T] = lambda: None, repeat: int = 3) -> tuple[Any, float]:
+    """Run func on the result of setup repeat times, and return its last result with the best wall time. setup is not measured."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        arg = setup()
+        start = perf_counter()
+        result = func(arg)
+        best = min(best, perf_counter() - start)
+    return result, best
+
+
+def measure_render(get_render: Callable[[MetricsSink], Render], repeat: int = 3) -> dict[str, float]:
+    """
+    Rasterize repeat times with a metrics sink, and get the best time of
+    each stage of Render.render, the whole 'render' included.
+    """
+    best: dict[str, float] = {}
+    for _ in range(repeat):
+        stages: list[StageMetrics] = []
+        get_render(stages.append).render()
+        for stage in stages:
+            best[stage.stage] = min(best.get(stage.stage, float('inf')), stage.duration)
+    return best
+
+
+def get_stages(content: bytes, meta: ChartMeta, jacket: bytes) -> dict[str, tuple[Callable[[], Any], Callable[[Any], Any]]]:
+    """Get the setup and the measured function of each stage, from parsing the chart to encoding the image."""
+    chart = parse_obj_as(Chart, json.loads(content))
+
+    def get_render() -> Render:
+        return Render(chart, meta, BytesIO(jacket))
+
+    def get_rendered() -> Render:
+        render = get_render()
+        render.render()
+        return render
+
+    return {
+        'parse': (lambda: None, lambda _: parse_obj_as(Chart, json.loads(content))),
+        'parse_fast': (lambda: None, lambda _: parse_chart_fast(content)),
+        'construct': (lambda: None, lambda _: get_render()),
+        'render': (get_render, lambda render: render.render()),
+        'encode': (get_rendered, lambda render: render.to_bytes_io()),
+        'encode_fastest': (get_rendered, lambda render: render.to_bytes_io(preset='fastest')),
+    }
+
+
+def get_rss_delta(content: bytes, meta: ChartMeta, jacket: bytes, stage: str) -> Optional[int]:
+    """Run a stage once after its setup, and get its peak resident memory above the memory it started with."""
+    setup, func = get_stages(content, meta, jacket)[stage]
+    arg = setup()
+    gc.collect()
+    if not reset_peak_rss():
+        return None
+    start = get_rss()
+    func(arg)
+    return get_rss('VmHWM') - start
+
+
+def measure_rss_delta(content: bytes, meta: ChartMeta, jacket: bytes, stage: str) -> Optional[int]:
+    """Measure get_rss_delta in a fresh process, so that memory kept by the earlier stages does not skew it."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(get_rss_delta, content, meta, jacket, stage).result()
+
+
+def benchmark_chart(
+        content: bytes, meta: ChartMeta, jacket: bytes, repeat: int = 3, memory: bool = False
+) -> dict[str, dict[str, Optional[float]]]:
+    """
+    Measure every stage from parsing the chart to encoding the image, and the
+    stages of the rasterization reported by the metrics of Render, e.g.
+    'render.notes'. With memory=True, each top-level stage is also run once
+    in a fresh process for its rss_delta, the render.* stages have a time
+    only.
+    """
+    chart = parse_obj_as(Chart, json.loads(content))
+    stages = {}
+    for stage, (setup, func) in get_stages(content, meta, jacket).items():
+        if stage == 'render':
+            render_stages = measure_render(lambda sink: Render(chart, meta, BytesIO(jacket), metrics=sink), repeat)
+            stages['render'] = {'time': render_stages.pop('render')}
+            stages.update({f'render.{name}': {'time': duration} for name, duration in render_stages.items()})
+        else:
+            stages[stage] = {'time': measure(func, setup, repeat)[1]}
+        if memory:
+            stages[stage]['rss_delta'] = measure_rss_delta(content, meta, jacket, stage)
+    return stages
+
+
+def load_fixtures(path: Path = benchmark_fixtures) -> dict[str, tuple[bytes, ChartMeta]]:
+    """Load the recorded charts, named after their files."""
+    fixtures = {}
+    for file in sorted(path.glob('*.json')):
+        fixture = json.loads(file.read_bytes())
+        fixtures[file.stem] = json.dumps(fixture['chart']).encode(), ChartMeta.parse_obj(fixture['meta'])
+    return fixtures
+
+
+async def record_fixture(key: Union[tuple[int, int], int], path: Path = benchmark_fixtures) -> Path:
+    """
+    Download a chart from bestdori.com into path, (song_id, difficulty) for an
+    official chart or post_id for a community chart. The jacket is not kept,
+    the benchmark always uses the default one.
+    """
+    if isinstance(key, tuple):
+        chart, meta, _ = await get_chart_resources_official(*key)
+        name = f'official_{key[0]}_{key[1]}'
+    else:
+        chart, meta, _ = await get_chart_resources_user_post(key)
+        name = f'user_post_{key}'
+
+    path.mkdir(parents=True, exist_ok=True)
+    file = path / f'{name}.json'
+    file.write_text(json.dumps({
+        'meta': json.loads(meta.json()),
+        'chart': json.loads(chart.json(exclude_none=True)),
+    }, ensure_ascii=False), encoding='utf-8')
+    return file
+
+
+def run_benchmark(
+        cases: Optional[list[str]] = None, repeat: int = 3, fixtures: Path = benchmark_fixtures, memory: bool = False
+) -> dict[str, Any]:
+    """Benchmark the synthetic charts and the recorded ones, all of them if cases is None."""
+    charts = {name: (json.dumps(generate_chart(**options)).encode(), synthetic_meta) for name, options in synthetic_cases.items()}
+    charts.update(load_fixtures(fixtures))
+    jacket = IGRMngr.default_jacket.read_bytes()
+
+    results = {}
+    for name, (content, meta) in charts.items():
+        if cases is None or name in cases:
+            results[name] = benchmark_chart(content, meta, jacket, repeat, memory)
+            print(f'{name}: ' + ', '.join(f'{stage} {result["time"] * 1000:.0f}ms' for stage, result in results[name].items()),
+                  file=sys.stderr)
+
+    return {
+        'environment': {
+            'renderer_version': renderer_version,
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+        'cases': results,
+    }
+
+
+def compare_results(old: dict[str, Any], new: dict[str, Any]) -> str:
+    """Format the wall time of each stage of two runs side by side, for the cases and stages in both."""
+    lines = [f'{"case":<24}{"stage":<28}{"old":>10}{"new":>10}{"ratio":>8}']
+    for name, stages in new['cases'].items():
+        for stage, result in stages.items():
+            old_result = old['cases'].get(name, {}).get(stage)
+            if old_result is not None:
+                lines.append(
+                    f'{name:<24}{stage:<28}{old_result["time"] * 1000:>8.1f}ms{result["time"] * 1000:>8.1f}ms'
+                    f'{result["time"] / old_result["time"]:>8.2f}'
+                )
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(prog='python -m BandoriChartRender.benchmark', description='Offline benchmark of Render.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='benchmark the synthetic and recorded charts')
+    run_parser.add_argument('cases', nargs='*', help='names of the cases to run, all by default')
+    run_parser.add_argument('-o', '--output', type=Path, help='save the results as JSON')
+    run_parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of each stage, the best is kept')
+    run_parser.add_argument('-m', '--memory', action='store_true', help='measure the memory of each stage in a fresh process (Linux only)')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two saved results')
+    compare_parser.add_argument('old', type=Path)
+    compare_parser.add_argument('new', type=Path)
+
+    record_parser = subparsers.add_parser('record', help='download real charts from bestdori.com as fixtures')
+    record_parser.add_argument('charts', nargs='+', help='song_id:difficulty for official charts, post_id for community charts')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run_benchmark(args.cases or None, args.repeat, memory=args.memory)
+        output = json.dumps(results, indent=2)
+        if args.output:
+            args.output.write_text(output, encoding='utf-8')
+        else:
+            print(output)
+    elif args.command == 'compare':
+        print(compare_results(json.loads(args.old.read_bytes()), json.loads(args.new.read_bytes())))
+    else:
+        for chart in args.charts:
+            key = tuple(map(int, chart.split(':'))) if ':' in chart else int(chart)
+            print(asyncio.run(record_fixture(key)))
+
+
+if __name__ == '__main__':
+    main()
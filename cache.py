@@ -0,0 +1,144 @@
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Iterator, NamedTuple, Optional, Union
+
+default_cache_path = Path.home() / '.cache' / 'BandoriChartRender' / 'cache.sqlite3'
+
+
+class CacheMissError(LookupError):
+    """Raised in offline mode when a resource is not in the cache."""
+
+
+class CacheEntry(NamedTuple):
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float  # unix time of the last download or revalidation
+
+
+class CacheBackend(ABC):
+    """
+    Persistent store of downloaded resources, keyed by url.
+
+    The methods may block, they are called in worker threads off the event
+    loop, so they must be thread-safe.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CacheEntry]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: str, entry: CacheEntry):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """Cache in process memory, bounded by max_size bytes."""
+
+    def __init__(self, max_size: int = 64 * 1024 * 1024):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = entry
+            self._size += len(entry.content)
+            while self._size > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.content)
+
+
+class SQLiteCache(CacheBackend):
+    """Cache in a SQLite database, shared by all processes on one host and bounded by max_size bytes."""
+
+    def __init__(self, path: Union[str, Path] = default_cache_path, max_size: int = 256 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, content BLOB NOT NULL, etag TEXT, last_modified TEXT, '
+                'stored_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT content, etag, last_modified, stored_at FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (time(), key))
+        return CacheEntry(*row)
+
+    def set(self, key: str, entry: CacheEntry):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, entry.content, entry.etag, entry.last_modified, entry.stored_at, time(), len(entry.content))
+            )
+            # evict the least recently used entries until the total size fits
+            connection.execute(
+                'DELETE FROM entries WHERE key IN ('
+                'SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM entries) '
+                'WHERE total > ?)',
+                (self.max_size,)
+            )
+
+    def delete(self, key: str):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM entries')
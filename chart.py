@@ -1,7 +1,10 @@
-from itertools import tee, chain, groupby
+from bisect import bisect_right
+from itertools import tee, chain, groupby, accumulate
 from typing import Union, TypeVar, Iterator, Iterable, Optional
 
-from .model import Chart, Slide, LaneLocated, Single, Directional, Connection, BPM, NoteBase, Command
+import numpy as np
+
+from .model import Chart, Slide, LaneLocated, Single, Directional, Connection, BPM, NoteBase, Command, Direction
 
 _T = TypeVar('_T', bound=NoteBase)
 
@@ -132,6 +135,68 @@ def get_beat_elapsed(bpms: list[BPM], time: float) -> float:
     return current_beat
 
 
+class TempoMap(object):
+    """
+    Beat <-> time conversion built once from the BPM notes of a chart.
+
+    The start time of every BPM segment is accumulated in advance, so each
+    conversion is a bisect instead of a walk over the whole BPM list. Results
+    are the same as get_time_elapsed and get_beat_elapsed.
+    """
+
+    def __init__(self, bpms: list[BPM]):
+        self._bpms = [bpm.bpm for bpm in bpms]
+        self._beats = [bpm.beat for bpm in bpms]
+        self._times = []
+
+        current_time = 0.0
+        current_bpm = bpms[0].bpm
+        current_beat = 0.0
+
+        for bpm in bpms:
+            current_time += (bpm.beat - current_beat) * 60 / current_bpm
+            current_bpm = bpm.bpm
+            current_beat = bpm.beat
+            self._times.append(current_time)
+
+        # the walk stops at the first BPM note past the target, running maxima keep this for unsorted lists
+        self._beats_max = list(accumulate(self._beats, max))
+        self._times_max = list(accumulate(self._times, max))
+
+        # the same per segment, as arrays indexed by the result of searchsorted for the batch conversions
+        self._segment_times = np.array([0.0] + self._times, np.float64)
+        self._segment_beats = np.array([0.0] + self._beats, np.float64)
+        self._segment_bpms = np.array(self._bpms[:1] + self._bpms, np.float64)
+
+    def _get_segment(self, index: int) -> tuple[float, float, float]:
+        """Get the start time, start beat and BPM of the segment before the index-th BPM note."""
+        if index == 0:
+            return 0.0, 0.0, self._bpms[0]
+        return self._times[index - 1], self._beats[index - 1], self._bpms[index - 1]
+
+    def get_time_elapsed(self, beat: float) -> float:
+        """Get the elapsed time of a beat."""
+        current_time, current_beat, current_bpm = self._get_segment(bisect_right(self._beats_max, beat))
+        return current_time + (beat - current_beat) * 60 / current_bpm
+
+    def get_beat_elapsed(self, time: float) -> float:
+        """Get the elapsed beat of a time."""
+        current_time, current_beat, current_bpm = self._get_segment(bisect_right(self._times_max, time))
+        return current_beat + (time - current_time) * current_bpm / 60
+
+    def get_times_elapsed(self, beats: Iterable[float]) -> np.ndarray:
+        """Get the elapsed time of many beats in one call."""
+        beats = np.asarray(beats, np.float64)
+        indices = np.searchsorted(self._beats_max, beats, 'right')
+        return self._segment_times[indices] + (beats - self._segment_beats[indices]) * 60 / self._segment_bpms[indices]
+
+    def get_beats_elapsed(self, times: Iterable[float]) -> np.ndarray:
+        """Get the elapsed beat of many times in one call."""
+        times = np.asarray(times, np.float64)
+        indices = np.searchsorted(self._times_max, times, 'right')
+        return self._segment_beats[indices] + (times - self._segment_times[indices]) * self._segment_bpms[indices] / 60
+
+
 def get_combo_before(beat: float, note_list_single_directional: list[Union[Single, Directional]], note_list_slide: list[Slide]) -> int:
     """Get the total combo before given beat."""
     return get_combo_between(0, beat, note_list_single_directional, note_list_slide)
@@ -159,7 +224,117 @@ def get_combo_between(
     return result
 
 
+class ComboIndex(object):
+    """
+    Sorted beats of all notes that count towards combo, built once per chart.
+
+    Queries follow the same rules as get_combo_between: both ends are
+    included, and hidden slide connections are skipped.
+    """
+
+    def __init__(self, beats: Iterable[float]):
+        self._beats = np.sort(np.fromiter(beats, np.float64))
+
+    def __len__(self) -> int:
+        return len(self._beats)
+
+    def get_combo_before(self, beat: float) -> int:
+        """Get the total combo before given beat."""
+        return self.get_combo_between(0, beat)
+
+    def get_combo_between(self, beat_start: float, beat_end: float) -> int:
+        """Get the total combo between given beats. Include both ends."""
+        return max(int(np.searchsorted(self._beats, beat_end, 'right') - np.searchsorted(self._beats, beat_start, 'left')), 0)
+
+
 def get_min_max_bpm(bpms: list[BPM]) -> tuple[float, float]:
     """Get the max and min BPM of a chart."""
     bpms = sorted(bpms, key=lambda bpm: bpm.bpm)
     return bpms[0].bpm, bpms[-1].bpm
+
+
+class ChartArrays(object):
+    """
+    Columnar view of the lane-located notes of a chart, built once.
+
+    Each Single, Directional and slide Connection is a row of the arrays.
+    Singles and directionals come first in chart order, then the connections
+    of every slide, so the rows of the i-th slide are
+    slide_offsets[i]:slide_offsets[i + 1]. Queries give the same results, in
+    the same order, as the functions of this module.
+    """
+
+    type_single, type_directional, type_connection = 0, 1, 2
+    flag_flick, flag_skill, flag_hidden, flag_charge = 1, 2, 4, 8
+
+    def __init__(self, chart: Chart):
+        single_directional_list = list(get_notes_for_type(chart, (Single, Directional)))
+        slide_list = list(get_notes_for_type(chart, Slide))
+
+        notes: list[LaneLocated] = single_directional_list + [
+            connection for slide in slide_list for connection in slide.connections
+        ]
+        self.slide_offsets = np.cumsum([len(single_directional_list)] + [len(slide.connections) for slide in slide_list])
+
+        count = len(notes)
+        self.beat = np.fromiter((note.beat for note in notes), np.float64, count)
+        self.lane = np.fromiter((note.lane for note in notes), np.float64, count)
+        self.type = np.fromiter((
+            self.type_single if isinstance(note, Single) else
+            self.type_directional if isinstance(note, Directional) else
+            self.type_connection
+            for note in notes
+        ), np.int8, count)
+        self.flags = np.fromiter((
+            self.flag_flick * (getattr(note, 'flick', None) is True) |
+            self.flag_skill * bool(getattr(note, 'skill', None)) |
+            self.flag_hidden * bool(getattr(note, 'hidden', None)) |
+            self.flag_charge * bool(getattr(note, 'charge', None))
+            for note in notes
+        ), np.uint8, count)
+        self.direction = np.fromiter((  # -1 for Left, 1 for Right
+            {Direction.Left: -1, Direction.Right: 1}[note.direction] if isinstance(note, Directional) else 0
+            for note in notes
+        ), np.int8, count)
+        self.width = np.fromiter((getattr(note, 'width', 0) for note in notes), np.int8, count)
+        self.slide = np.concatenate((  # -1 for notes out of slides
+            np.full(len(single_directional_list), -1, np.int32),
+            np.repeat(np.arange(len(slide_list), dtype=np.int32), np.diff(self.slide_offsets))
+        ))
+
+        self.max_beat = max(chain(
+            self.beat[self.type != self.type_connection],
+            self.beat[self.slide_offsets[1:] - 1],
+            (note.beat for note in chart.__root__ if isinstance(note, (BPM, Command))),
+        ))
+        self.combo_index = ComboIndex(self.beat[(self.flags & self.flag_hidden) == 0])
+
+    def __len__(self) -> int:
+        return len(self.beat)
+
+    def get_rows(self, *note_types: int) -> np.ndarray:
+        """Get the rows of notes of the given type codes, in order."""
+        return np.flatnonzero(np.isin(self.type, note_types))
+
+    def get_endpoint_rows(self) -> np.ndarray:
+        """Get the rows of the head and tail of every slide, in the order of get_endpoints_for_slide."""
+        return np.stack((self.slide_offsets[:-1], self.slide_offsets[1:] - 1), axis=1).ravel()
+
+    def get_is_endpoint(self) -> np.ndarray:
+        """Get whether each row is the head or tail of a slide."""
+        is_endpoint = np.zeros(len(self), bool)
+        is_endpoint[self.get_endpoint_rows()] = True
+        return is_endpoint
+
+    def get_skill_rows(self) -> np.ndarray:
+        """Get the rows of all skill notes, in the order of get_all_skill_notes."""
+        rows = np.concatenate((self.get_rows(self.type_single), self.get_endpoint_rows()))
+        rows = rows[(self.flags[rows] & self.flag_skill) != 0]
+        return rows[np.argsort(self.beat[rows], kind='stable')]
+
+    def get_simultaneous_rows(self) -> list[np.ndarray]:
+        """Get the rows of every group of more than one note on the same beat, in the order of get_grouped_notes_by_beat."""
+        rows = np.concatenate((self.get_rows(self.type_single, self.type_directional), self.get_endpoint_rows()))
+        rows = rows[np.argsort(self.beat[rows], kind='stable')]
+        _, starts, counts = np.unique(self.beat[rows], return_index=True, return_counts=True)
+        return [rows[start:start + count] for start, count in zip(starts, counts) if count > 1]
@@ -0,0 +1,134 @@
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+precision_bits = 7  # fixed point precision of the blending coefficients, the same as in Pillow
+
+
+def _div255(x: np.ndarray) -> np.ndarray:
+    """Rounded-down division by 255 of Pillow, valid for the products of two channels."""
+    return ((x >> 8) + x) >> 8
+
+
+def _get_blend_tables() -> tuple[np.ndarray, np.ndarray]:
+    """Get the coefficient of the source color and the output alpha, indexed by (source alpha, destination alpha)."""
+    src_a = np.arange(256, dtype=np.uint32)[:, None]
+    dst_a = np.arange(256, dtype=np.uint32)[None, :]
+    out_a255 = src_a * 255 + dst_a * (255 - src_a)
+    coef = src_a * (255 * 255 << precision_bits) // np.maximum(out_a255, 1)
+    return coef.astype(np.uint32), _div255(out_a255 + 0x80).astype(np.uint8)
+
+
+blend_coef_table, blend_alpha_table = _get_blend_tables()
+
+
+def alpha_composite_array(dst: np.ndarray, src: np.ndarray) -> np.ndarray:
+    """
+    Composite RGBA pixels src over dst, both of shape (..., 4).
+
+    The integer arithmetic is the same as in Image.alpha_composite, so the
+    result is identical to it.
+    """
+    src_a, dst_a = src[..., 3].astype(np.intp), dst[..., 3]
+    table_indices = src_a * 256 + dst_a
+    coef = blend_coef_table.take(table_indices)[..., None]
+    color = src[..., :3] * coef + dst[..., :3] * ((255 << precision_bits) - coef) + (0x80 << precision_bits)
+
+    result = np.empty(np.broadcast_shapes(dst.shape, src.shape), np.uint8)
+    result[..., :3] = _div255(color) >> precision_bits
+    result[..., 3] = blend_alpha_table.take(table_indices)
+    return np.where((src_a > 0)[..., None], result, dst)
+
+
+def get_ragged_indices(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenate the ranges of counts indices from starts, e.g. ([0, 5], [2, 3]) gives [0, 1, 5, 6, 7]."""
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def get_layers(indices: np.ndarray) -> np.ndarray:
+    """Number each index by how many times it occurred before, e.g. [3, 1, 3, 3] gives [0, 0, 1, 2]."""
+    order = np.argsort(indices, kind='stable')
+    sorted_indices = indices[order]
+    is_first = np.empty(len(indices), bool)
+    is_first[:1] = True
+    np.not_equal(sorted_indices[1:], sorted_indices[:-1], out=is_first[1:])
+    positions = np.arange(len(indices))
+    layers = np.empty(len(indices), np.int64)
+    layers[order] = positions - np.maximum.accumulate(np.where(is_first, positions, 0))
+    return layers
+
+
+class _SpritePixels(NamedTuple):
+    sprite: Image.Image  # kept alive, so that its id is not reused
+    ys: np.ndarray  # rows of the visible pixels
+    xs: np.ndarray  # columns of the visible pixels
+    pixels: np.ndarray  # visible pixels
+
+
+class SpriteBatch(object):
+    """
+    Sprites to composite onto an image, collected in draw order and then
+    composited all at once with NumPy.
+
+    The visible pixels of all sprites are blended in layers: the first layer
+    holds the first sprite pixel over each canvas pixel, the next layer the
+    second one, and so on. Each layer is blended with vectorized operations,
+    and the pixels over the same canvas pixel are still blended in the order
+    they were added, so the result is identical to calling
+    Image.alpha_composite for each sprite.
+    """
+
+    def __init__(self):
+        self._sprites: dict[int, _SpritePixels] = {}  # id(sprite): its pixels, kept across batches
+        self._placements: list[tuple[int, int, int]] = []  # (id(sprite), left, top)
+
+    def __len__(self) -> int:
+        return len(self._placements)
+
+    def __getstate__(self) -> dict:
+        return {'_sprites': {}, '_placements': []}  # ids are meaningless in another process
+
+    def add(self, sprite: Image.Image, dest: tuple[int, int]):
+        """Queue sprite to be composited with its upper left corner at dest."""
+        if id(sprite) not in self._sprites:
+            pixels = np.asarray(sprite)
+            ys, xs = np.nonzero(pixels[..., 3])
+            self._sprites[id(sprite)] = _SpritePixels(sprite, ys, xs, pixels[ys, xs])
+        self._placements.append((id(sprite), *dest))
+
+    def composite(self, im: Image.Image):
+        """Composite every queued sprite onto im, and empty the batch."""
+        if not self._placements:
+            return
+
+        placements = np.array(self._placements, np.int64)
+        sprite_ids, placement_sprites = np.unique(placements[:, 0], return_inverse=True)
+        sprites = [self._sprites[sprite_id] for sprite_id in sprite_ids.tolist()]
+        sizes = np.array([sprite.sprite.size for sprite in sprites], np.int64)
+        boxes = np.concatenate((placements[:, 1:], placements[:, 1:] + sizes[placement_sprites]), axis=1)
+
+        # work on the area covered by the sprites only, zero-padded where they
+        # reach outside im like Image.alpha_composite does
+        region_box = (*boxes[:, :2].min(axis=0).tolist(), *boxes[:, 2:].max(axis=0).tolist())
+        region = np.array(im.crop(region_box))
+        region_flat = region.reshape(-1, 4)
+        width = region.shape[1]
+
+        # the visible pixels of every placement in order, with their flat indices in region
+        counts = np.array([len(sprite.ys) for sprite in sprites], np.int64)
+        runs = get_ragged_indices((np.cumsum(counts) - counts)[placement_sprites], counts[placement_sprites])
+        offsets = np.concatenate([sprite.ys * width + sprite.xs for sprite in sprites])
+        origins = (boxes[:, 1] - region_box[1]) * width + boxes[:, 0] - region_box[0]
+        indices = np.repeat(origins, counts[placement_sprites]) + offsets[runs]
+        pixels = np.concatenate([sprite.pixels for sprite in sprites])[runs]
+
+        layers = get_layers(indices)
+        for layer in range(layers.max(initial=-1) + 1):
+            in_layer = layers == layer
+            layer_indices = indices[in_layer]
+            region_flat[layer_indices] = alpha_composite_array(region_flat[layer_indices], pixels[in_layer])
+
+        im.paste(Image.fromarray(region), region_box)
+        self._placements.clear()
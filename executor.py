@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Optional, TypeVar
+
+from .model import Chart, ChartMeta
+from .render import Render
+
+_T = TypeVar('_T')
+
+
+class RenderQueueFullError(RuntimeError):
+    """Raised when a render is submitted while the queue of a RenderExecutor is full."""
+
+
+def render_eagerly(chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None) -> Render:
+    """Build and rasterize a Render, picklable for process pools."""
+    return Render(chart, meta, jacket, eager=True)
+
+
+def render_to_bytes(
+        chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None,
+        format: Optional[str] = None, preset: Optional[str] = None
+) -> bytes:
+    """Build, rasterize and encode a Render, picklable for process pools."""
+    return Render(chart, meta, jacket).to_bytes_io(format, preset).getvalue()
+
+
+class RenderExecutor(object):
+    """
+    Run renders in an executor, off the event loop.
+
+    At most max_concurrency renders run at once and at most max_queue more
+    wait for a slot, further submissions raise RenderQueueFullError. Any
+    concurrent.futures executor can be used, e.g. a ProcessPoolExecutor for
+    CPU parallelism; a ThreadPoolExecutor of max_concurrency threads is
+    created if none is given.
+    """
+
+    def __init__(self, executor: Optional[Executor] = None, max_concurrency: int = 2, max_queue: int = 16):
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_concurrency, thread_name_prefix='render')
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._semaphore: Optional[asyncio.Semaphore] = None  # created in the running loop
+        self._pending = 0
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    @property
+    def max_queue(self) -> int:
+        return self._max_queue
+
+    @property
+    def pending(self) -> int:
+        """Number of renders running or waiting."""
+        return self._pending
+
+    async def submit(self, chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None) -> Render:
+        """Build and rasterize a Render in the executor, and return it once done."""
+        return await self._run(render_eagerly, chart, meta, jacket)
+
+    async def submit_bytes(
+            self, chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None,
+            format: Optional[str] = None, preset: Optional[str] = None
+    ) -> bytes:
+        """Render and encode a chart in the executor, and return the encoded image once done."""
+        return await self._run(render_to_bytes, chart, meta, jacket, format, preset)
+
+    async def _run(self, func: Callable[..., _T], *args) -> _T:
+        if self._pending >= self._max_concurrency + self._max_queue:
+            raise RenderQueueFullError(f'{self._pending} renders are already pending')
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        self._pending += 1
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self, wait: bool = True):
+        """Shut down the executor, if it was created by this RenderExecutor."""
+        if self._own_executor:
+            self._executor.shutdown(wait)
@@ -0,0 +1,98 @@
+import logging
+from threading import Lock
+from typing import Callable, NamedTuple, Optional
+
+
+class StageMetrics(NamedTuple):
+    stage: str
+    duration: float  # seconds, summed over every column for the stages drawn column by column
+    size: tuple[int, int]  # size of the canvas after the stage, the last column for the column stages
+    counts: dict[str, int]  # items handled by the stage, e.g. notes, slides, skills or bars
+
+
+MetricsSink = Callable[[StageMetrics], None]
+
+
+class StageRecorder(object):
+    """Durations and counts of the stages of one render, summed until they are emitted."""
+
+    def __init__(self):
+        self._stages: dict[str, tuple[float, tuple[int, int], dict[str, int]]] = {}  # stage: (duration, size, counts)
+
+    def add(self, stage: str, duration: float, size: tuple[int, int], counts: dict[str, int]):
+        if stage in self._stages:
+            total_duration, _, total_counts = self._stages[stage]
+            duration += total_duration
+            counts = {name: total_counts.get(name, 0) + count for name, count in counts.items()}
+        self._stages[stage] = duration, size, counts
+
+    def emit(self, sink: MetricsSink):
+        """Send every stage to sink in the order they first ran, and start over."""
+        for stage, (duration, size, counts) in self._stages.items():
+            sink(StageMetrics(stage, duration, size, counts))
+        self._stages.clear()
+
+
+class LoggingSink(object):
+    """Log each stage, with its metrics in the extra attributes of the record for structured log handlers."""
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.DEBUG):
+        self.logger = logger or logging.getLogger('BandoriChartRender')
+        self.level = level
+
+    def __call__(self, metrics: StageMetrics):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        self.logger.log(
+            self.level, 'render stage %s took %.1f ms on %dx%d %s',
+            metrics.stage, metrics.duration * 1000, *metrics.size, metrics.counts,
+            extra={
+                'render_stage': metrics.stage,
+                'render_duration': metrics.duration,
+                'render_width': metrics.size[0],
+                'render_height': metrics.size[1],
+                'render_counts': metrics.counts,
+            }
+        )
+
+
+class PrometheusSink(object):
+    """
+    Accumulate the stages into Prometheus counters, exposed in the text
+    format by expose(), e.g. from the /metrics endpoint of a web service.
+    """
+
+    def __init__(self, namespace: str = 'bandori_chart_render'):
+        self.namespace = namespace
+        self._seconds: dict[str, float] = {}  # stage: total seconds
+        self._runs: dict[str, int] = {}  # stage: count of runs
+        self._pixels: dict[str, int] = {}  # stage: total pixels of the canvas
+        self._items: dict[tuple[str, str], int] = {}  # (stage, item): total count
+        self._lock = Lock()
+
+    def __call__(self, metrics: StageMetrics):
+        with self._lock:
+            self._seconds[metrics.stage] = self._seconds.get(metrics.stage, 0) + metrics.duration
+            self._runs[metrics.stage] = self._runs.get(metrics.stage, 0) + 1
+            self._pixels[metrics.stage] = self._pixels.get(metrics.stage, 0) + metrics.size[0] * metrics.size[1]
+            for item, count in metrics.counts.items():
+                self._items[metrics.stage, item] = self._items.get((metrics.stage, item), 0) + count
+
+    def expose(self) -> str:
+        """Get the counters in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = [
+                ('stage_seconds_total', 'Time spent in each render stage.', {(stage,): value for stage, value in self._seconds.items()}),
+                ('stage_runs_total', 'Runs of each render stage.', {(stage,): value for stage, value in self._runs.items()}),
+                ('stage_pixels_total', 'Canvas pixels after each render stage.', {(stage,): value for stage, value in self._pixels.items()}),
+                ('stage_items_total', 'Items handled by each render stage.', dict(self._items)),
+            ]
+
+        lines = []
+        for name, help_text, values in metrics:
+            lines.append(f'# HELP {self.namespace}_{name} {help_text}')
+            lines.append(f'# TYPE {self.namespace}_{name} counter')
+            for labels, value in values.items():
+                label_text = f'stage="{labels[0]}"' + (f',item="{labels[1]}"' if len(labels) > 1 else '')
+                lines.append(f'{self.namespace}_{name}{{{label_text}}} {value}')
+        return '\n'.join(lines) + '\n'
@@ -1,17 +1,25 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 from io import BytesIO
-from math import ceil
+from math import ceil, floor, sqrt
 from pathlib import Path
-from typing import Optional, Union
+from threading import Lock
+from time import perf_counter
+from typing import Any, BinaryIO, Callable, Literal, NamedTuple, Optional, Union, Iterator, Sequence, TypeVar
 
-from PIL import Image, ImageDraw
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
 from .chart import (
-    get_max_beat, get_notes_for_type, get_all_skill_notes, get_fever_command_tuple,
-    is_note_should_black, is_note_skill, is_note_flick,
+    get_notes_for_type, get_fever_command_tuple,
     pairwise,
-    get_grouped_notes_by_beat, get_time_elapsed, get_beat_elapsed, get_combo_before, get_combo_between, get_min_max_bpm
+    get_min_max_bpm,
+    ChartArrays, TempoMap
 )
-from .model import Chart, Single, LaneLocated, Directional, Direction, Connection, BPM, Slide, Command, ChartMeta
+from .compositor import SpriteBatch
+from .metrics import MetricsSink, StageMetrics, StageRecorder
+from .model import Chart, BPM, Command, ChartMeta
 from .resource import InGameResourceManager as IGRMngr
 from .theme import (
     BaseTheme,
@@ -23,6 +31,7 @@ from .theme import (
     width_track_extra,
     width_note_resize,
     width_song_jacket, height_song_jacket,
+    width_part_footer_min,
     height_bar, height_beat,
     height_bar_extra,
     margin,
@@ -33,6 +42,40 @@ from .theme import (
 )
 from .utils import second_to_sexagesimal
 
+_T = TypeVar('_T')
+cached_sprites: dict[tuple[Path, int, bool], Image.Image] = {}  # (path, target_width, back_projection): sprite
+cached_bar_tiles: dict[tuple[type[BaseTheme], int], Image.Image] = {}  # (theme, width): bar tile
+# (theme, size, footer, difficulty): background plate, least recently used first
+cached_background_plates: OrderedDict[tuple[type[BaseTheme], tuple[int, int], bool, int], Image.Image] = OrderedDict()
+cached_background_plates_lock = Lock()
+background_plate_cache_pixels = 32_000_000  # max total pixels of cached background plates, 128 MB in RGBA
+renderer_version = 1  # bump whenever the rendered image changes, to invalidate cached renders
+text_stamp_cache_size = 4096  # max count of cached text stamps, each is a few hundred bytes
+encoding_presets: dict[str, dict[str, Any]] = {  # name: options of save_image, see README for the tradeoffs
+    'fastest': {'format': 'PNG', 'compress_level': 1},
+    'smallest': {'format': 'PNG', 'colors': 256, 'compress_level': 9},
+}
+canvas_max_pixels = 100_000_000  # default budget of pixels of the full image, 400 MB in RGBA, peak memory is a few times that
+canvas_min_scale = 0.1  # smallest scale the downscale fallback may use, below that the chart is rejected
+canvas_max_segments = 512  # most segments the downscale fallback may rasterize, each at full size whatever the scale
+trim_gap_bars = 16  # empty bars after which the trim fallback drops the notes past the bulk of the chart
+webp_max_size = 16383  # max width and height of a WebP image
+window_margin_beat = 1  # how far comments and note sprites may reach outside their beats, far more than they actually do
+note_sprites: dict[str, tuple[Path, int, bool]] = {  # name: arguments of get_sprite, coded by their order
+    'normal': (IGRMngr.normal, width_note_resize, True),
+    'normal_16': (IGRMngr.normal_16, width_note_resize, True),
+    'flick': (IGRMngr.flick, width_note_resize, True),
+    'skill': (IGRMngr.skill, width_note_resize, True),
+    'long': (IGRMngr.long, width_note_resize, True),
+    'connection': (IGRMngr.connection, width_note_resize, True),
+    'flick_top': (IGRMngr.flick_top, width_lane, False),
+    'flick_left': (IGRMngr.flick_left, width_note_resize, True),
+    'flick_right': (IGRMngr.flick_right, width_note_resize, True),
+    'flick_left_top': (IGRMngr.flick_left_top, width_lane, False),
+    'flick_right_top': (IGRMngr.flick_right_top, width_lane, False),
+}
+note_sprite_codes = {name: code for code, name in enumerate(note_sprites)}
+
 
 def resize_as_width(image: Image.Image, target_width: int, back_projection: Optional[bool] = False) -> Image.Image:
     """
@@ -73,138 +116,793 @@ def open_image_resized(path: Path, target_width: int = width_note_resize, back_p
     return resize_as_width(Image.open(path).convert('RGBA'), target_width, back_projection)
 
 
+def get_sprite(path: Path, target_width: int = width_note_resize, back_projection: Optional[bool] = True) -> Image.Image:
+    """
+    Get a decoded and resized note sprite from the process-wide sprite cache.
+
+    The returned image is shared by all renders, so it must not be modified.
+    """
+    key = (path, target_width, bool(back_projection))
+    if key not in cached_sprites:
+        cached_sprites[key] = open_image_resized(path, target_width, back_projection)
+    return cached_sprites[key]
+
+
+def clear_cached_sprites() -> None:
+    """Invalidate the sprite and background plate caches, e.g. after the assets have been replaced."""
+    cached_sprites.clear()
+    with cached_background_plates_lock:
+        cached_background_plates.clear()
+
+
+def get_background_plate(theme: type[BaseTheme], size: tuple[int, int], footer: bool, difficulty: int) -> Image.Image:
+    """
+    Get the background of the whole image: the live background tinted by the
+    track background color, with the difficulty colored band behind the
+    footer. Plates are kept in an LRU cache bounded by
+    background_plate_cache_pixels.
+
+    The returned image is shared by all renders, so it must not be modified.
+    """
+    key = (theme, size, footer, difficulty)
+    with cached_background_plates_lock:
+        if key in cached_background_plates:
+            cached_background_plates.move_to_end(key)
+            return cached_background_plates[key]
+
+    bg = Image.open(IGRMngr.background).convert('RGBA')
+    bg_layer = Image.new('RGBA', size, theme.track_background_color)
+    bg = bg.crop((0, 0, bg.width, bg.height // 2)).resize(size)  # crop unwanted bottom part
+
+    if footer:
+        draw = ImageDraw.Draw(bg_layer)
+        draw.rectangle(
+            ((0, size[1] - 2 * margin_song_jacket - height_song_jacket), (bg.width, bg.height)),
+            theme.meta_difficulty_color[difficulty]
+        )
+
+    bg.alpha_composite(bg_layer, (0, 0))
+
+    with cached_background_plates_lock:
+        cached_background_plates[key] = bg
+        while sum(plate.width * plate.height for plate in cached_background_plates.values()) > background_plate_cache_pixels:
+            cached_background_plates.popitem(last=False)
+    return bg
+
+
+def get_bar_tile(theme: type[BaseTheme], width: int) -> Image.Image:
+    """
+    Get the empty track of a single bar with its lane, beat and bar dividers,
+    rasterized once per theme. The first row of the tile is the bar divider.
+
+    The returned image is shared by all renders, so it must not be modified.
+    """
+    key = (theme, width)
+    if key in cached_bar_tiles:
+        return cached_bar_tiles[key]
+
+    im_bar = Image.new('RGBA', (width, height_bar), theme.transparent_color)
+    draw = ImageDraw.Draw(im_bar)
+
+    # lane divider
+    for offset in range(8):
+        x1 = x2 = width_track_extra + offset * width_lane
+        draw.line((x1, 0, x2, height_bar), fill=theme.divider_lane_color)
+
+    # beat divider
+    for offset in range(4):
+        x2 = width - width_track_outline - width_divider
+        y1 = y2 = offset * height_beat
+        draw.line((width_track_extra, y1, x2, y2), fill=theme.divider_beat_color)
+
+    # bar divider
+    x1 = width_track_extra - width_track_outline
+    draw.line((x1, 0, width, 0), fill=theme.divider_bar_color)
+
+    cached_bar_tiles[key] = im_bar
+    return im_bar
+
+
+@lru_cache(maxsize=text_stamp_cache_size)
+def get_text_stamp(font: ImageFont.FreeTypeFont, text: str, anchor: Optional[str] = None) -> tuple[Image.Image, tuple[int, int]]:
+    """
+    Get the rasterized mask of a text and its offset from the anchor point.
+
+    The stamp holds no color, the fill is applied when it is drawn, so one
+    stamp serves every color. The cache is bounded, use
+    get_text_stamp.cache_clear() to drop it.
+    """
+    left, top, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font, anchor=anchor)
+    left, top = floor(left) - 1, floor(top) - 1  # 1 pixel padding against rounding of the bounding box
+    im_stamp = Image.new('L', (ceil(right) - left + 1, ceil(bottom) - top + 1))
+    ImageDraw.Draw(im_stamp).text((-left, -top), text, fill=255, font=font, anchor=anchor)
+    return im_stamp, (left, top)
+
+
+def draw_text_stamp(
+        draw: ImageDraw.ImageDraw, xy: tuple[int, int], text: str,
+        fill: tuple[int, ...], font: ImageFont.FreeTypeFont, anchor: Optional[str] = None
+) -> None:
+    """
+    Draw a text by blending its cached stamp with the fill color, which gives
+    the same pixels as draw.text at an integer position without rasterizing
+    the glyphs again.
+    """
+    im_stamp, (left, top) = get_text_stamp(font, text, anchor)
+    draw.bitmap((xy[0] + left, xy[1] + top), im_stamp, fill=fill)
+
+
+def save_image(
+        im: Image.Image, fp: Union[str, Path, BinaryIO],
+        format: Optional[str] = None, preset: Optional[str] = None, **options
+) -> None:
+    """
+    Save an image with encoder options, on top of the defaults of a preset of
+    encoding_presets. Besides the options of Pillow for the format, colors
+    quantizes to a palette of at most that many colors, and background
+    (black by default) is the color to flatten onto for formats without alpha.
+    """
+    preset_options = dict(encoding_presets[preset]) if preset is not None else {}
+    preset_format = preset_options.pop('format', None)
+    if format is None and isinstance(fp, (str, Path)):
+        format = Image.registered_extensions().get(Path(fp).suffix.lower())
+    format = (format or preset_format or 'PNG').upper()
+    options = {**preset_options, **options}
+    colors = options.pop('colors', None)
+    background = options.pop('background', (0, 0, 0))
+
+    if format == 'WEBP' and max(im.size) > webp_max_size:
+        raise ValueError(f'image of size {im.size} is too large for WebP, at most {webp_max_size} pixels each side')
+    if format == 'JPEG' and im.mode == 'RGBA':
+        im_flattened = Image.new('RGB', im.size, background)
+        im_flattened.paste(im, mask=im.getchannel('A'))
+        im = im_flattened
+    if colors is not None:
+        im = im.quantize(colors, method=Image.Quantize.FASTOCTREE)
+        if format == 'JPEG':  # JPEG has no palette mode, keep the quantized colors in RGB
+            im = im.convert('RGB')
+
+    im.save(fp, format, **options)
+
+
+def is_in_window(beat_start: float, beat_end: float, window: tuple[float, float]) -> bool:
+    """Check if an object between the given beats may be visible in a beat window."""
+    return beat_start <= window[1] + window_margin_beat and beat_end >= window[0] - window_margin_beat
+
+
+def get_bars_in_window(window: tuple[float, float], bar_count: int) -> range:
+    """Get the bars which may have objects visible in a beat window."""
+    return range(
+        max(floor((window[0] - window_margin_beat) / 4), 0),
+        min(floor((window[1] + window_margin_beat) / 4), bar_count - 1) + 1
+    )
+
+
+class CanvasTooLargeError(ValueError):
+    """Raised when the image of a chart would exceed the pixel budget, and no fallback makes it fit."""
+
+    def __init__(self, pixels: int, max_pixels: int):
+        super().__init__(pixels, max_pixels)  # the arguments are pickled, so that workers of a process pool can raise it
+        self.pixels = pixels
+        self.max_pixels = max_pixels
+
+    def __str__(self) -> str:
+        return f'image of {self.pixels} pixels exceeds the budget of {self.max_pixels} pixels'
+
+
+class BeatIndex(object):
+    """
+    Drawable objects of one kind, with the beats they cover.
+
+    The objects are sorted by their start beat once, so a query only visits
+    the objects starting near the window, and returns them in their original
+    order, so overlapping objects are drawn in the same order as before.
+    Items given as an array are queried as an array.
+    """
+
+    def __init__(self, items: Union[Sequence[_T], np.ndarray], beat_starts: Sequence[float], beat_ends: Sequence[float]):
+        beat_starts = np.asarray(beat_starts, np.float64)
+        beat_ends = np.asarray(beat_ends, np.float64)
+        self._items = items
+        self._order = np.argsort(beat_starts, kind='stable')
+        self._beat_starts = beat_starts[self._order]
+        self._beat_ends = beat_ends[self._order]
+        self._max_span = float((beat_ends - beat_starts).max(initial=0))
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def query_indices(self, window: tuple[float, float]) -> np.ndarray:
+        """Get the indices of all objects which may be visible in a beat window, in order."""
+        beat_min, beat_max = window[0] - window_margin_beat, window[1] + window_margin_beat
+        # an object reaching beat_min starts at most max_span before it, one more beat absorbs the rounding
+        start = np.searchsorted(self._beat_starts, beat_min - self._max_span - 1, 'left')
+        end = np.searchsorted(self._beat_starts, beat_max, 'right')
+        return np.sort(self._order[start + np.flatnonzero(self._beat_ends[start:end] >= beat_min)])
+
+    def query_starting_indices(self, window: tuple[float, float]) -> np.ndarray:
+        """Get the indices of the objects starting in a beat window, end excluded, so that each is in one window only."""
+        start, end = np.searchsorted(self._beat_starts, window, 'left')
+        return np.sort(self._order[start:end])
+
+    def query(self, window: tuple[float, float]) -> Union[list[_T], np.ndarray]:
+        """Get all objects which may be visible in a beat window."""
+        indices = self.query_indices(window)
+        if isinstance(self._items, np.ndarray):
+            return self._items[indices]
+        return [self._items[index] for index in indices]
+
+
+class SpritePlacements(NamedTuple):
+    """Note sprites in draw order, each centered on a row of ChartArrays with an offset."""
+    index: BeatIndex  # positions of the placements, by the beat of their row
+    rows: np.ndarray  # row of the note
+    sprites: np.ndarray  # sprite code, see note_sprites
+    offsets_x: np.ndarray  # added to the x of the center
+    offsets_y: np.ndarray  # subtracted from the Cartesian height of the center
+
+
+def get_sprite_placements(arrays: ChartArrays, *layers: tuple[int, np.ndarray, np.ndarray, np.ndarray, Any, Any]) -> SpritePlacements:
+    """
+    Merge layers of (group, steps, rows, sprites, offsets_x, offsets_y) into
+    placements drawn group by group, then row by row, then step by step.
+    """
+    groups, steps, rows, sprites, offsets_x, offsets_y = (np.concatenate([
+        np.broadcast_to(column, layer[2].shape) for column, layer in zip(columns, layers)
+    ]) for columns in zip(*layers))
+    order = np.lexsort((steps, rows, groups))
+    rows = rows[order]
+    return SpritePlacements(
+        BeatIndex(np.arange(len(rows)), arrays.beat[rows], arrays.beat[rows]),
+        rows, sprites[order], offsets_x[order], offsets_y[order]
+    )
+
+
 class Render(object):
+    """
+    Preview image of a chart.
+
+    Only the chart index is built on construction, the image is rasterized
+    on the first use of im, save, show or to_bytes_io, or by an explicit call
+    to render (e.g. in an executor). Pass eager=True to rasterize immediately.
+
+    The size of the full image is checked against max_pixels (None for no
+    limit) on construction. Beyond it, oversize tells what to do: 'reject'
+    raises CanvasTooLargeError, 'trim' drops the empty bars after the last
+    note, and stray notes more than trim_gap_bars empty bars past the bulk of
+    the chart, and 'downscale' shrinks the columns until they fit, for charts
+    of at most canvas_max_segments segments. The fallback taken is reported
+    by canvas_fallback.
+
+    compositor selects how note sprites are composited: 'pillow' composites
+    each sprite as it is drawn, 'numpy' batches the sprites of a window and
+    blends them with vectorized NumPy operations, see compositor.SpriteBatch.
+    Both give identical images.
+
+    metrics, if set, is called with a StageMetrics for each stage of the
+    pipeline once a render, a range or a part is done, and for encoding, see
+    metrics.LoggingSink and metrics.PrometheusSink. Stages drawn column by
+    column are summed over the columns.
+    """
+
+    def __init__(
+            self, chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None, eager: bool = False,
+            max_pixels: Optional[int] = canvas_max_pixels, oversize: Literal['reject', 'trim', 'downscale'] = 'reject',
+            compositor: Literal['pillow', 'numpy'] = 'pillow', metrics: Optional[MetricsSink] = None
+    ):
+        if compositor not in ('pillow', 'numpy'):
+            raise ValueError(f"compositor must be 'pillow' or 'numpy', got {compositor!r}")
 
-    def __init__(self, chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None):
         self._chart = chart
         self._meta = meta
         self._jacket = jacket
+        self._im: Optional[Image.Image] = None
+        self._is_rendered = False
+        self._render_lock = Lock()
+        self.theme = BaseTheme
+        self.metrics = metrics
+        self._stage_recorder: Optional[StageRecorder] = None
+        self._cached_arrays = ChartArrays(chart)
+        self._scale = 1.0
+        self._canvas_fallback: Optional[str] = None
+        self._sprite_batch = SpriteBatch() if compositor == 'numpy' else None
 
         # round up to an integer multiple of 4, and an extra 1 bar
-        self._last_beat = ceil(get_max_beat(chart) / 4 + 1) * 4
-        self._h_single_column = height_beat * self._last_beat + height_bar_extra * 2
+        self._last_beat = ceil(self._cached_arrays.max_beat / 4 + 1) * 4
         self._w_single_column = width_track_extra + width_track + width_divider + width_track_outline
+        if max_pixels is not None and self._get_canvas_pixels(self._last_beat) > max_pixels:
+            self._fit_canvas(max_pixels, oversize)
+        self._bar_count = ceil(self._last_beat / 4)
+        self._h_single_column = height_beat * self._last_beat + height_bar_extra * 2
 
         self._cache()
-        self._render()
+        if eager:
+            self.render()
+
+    @property
+    def meta(self) -> ChartMeta:
+        return self._meta
+
+    @property
+    def canvas_fallback(self) -> Optional[str]:
+        """'trim' or 'downscale' if the chart exceeded the pixel budget, otherwise None."""
+        return self._canvas_fallback
+
+    @property
+    def scale(self) -> float:
+        """Scale of the columns in the full image, below 1 after the downscale fallback."""
+        return self._scale
+
+    @property
+    def combo(self) -> int:
+        """Total combo of the chart, available without rasterizing."""
+        return self._cached_combo
+
+    @property
+    def duration(self) -> float:
+        """Duration of the chart in seconds, available without rasterizing."""
+        return self._cached_duration
+
+    @property
+    def im(self) -> Image.Image:
+        """The rendered image, rasterized on first access."""
+        return self.render()
+
+    def _get_canvas_pixels(self, last_beat: int, scale: float = 1.0) -> int:
+        """Get the pixel count of the full image, before anything is allocated."""
+        width = round(self._w_single_column * scale) * ceil(last_beat / 16)
+        if scale != 1:
+            width = max(width, width_part_footer_min)
+        height = round((height_bar * 4 + height_bar_extra * 2) * scale)
+        return (width + 2 * margin) * (height + 2 * margin + 2 * margin_song_jacket + height_song_jacket)
+
+    def _fit_canvas(self, max_pixels: int, oversize: str):
+        """Apply the fallback for a chart whose image exceeds max_pixels, or raise CanvasTooLargeError."""
+        if oversize == 'trim':
+            last_beat = ceil(self._get_bulk_end_beat() / 4 + 1) * 4
+            if self._get_canvas_pixels(last_beat) <= max_pixels:
+                self._last_beat = last_beat
+                self._canvas_fallback = 'trim'
+                return
+        elif oversize == 'downscale' and ceil(self._last_beat / 16) <= canvas_max_segments:
+            scale = sqrt(max_pixels / self._get_canvas_pixels(self._last_beat))
+            while scale >= canvas_min_scale and self._get_canvas_pixels(self._last_beat, scale) > max_pixels:
+                scale *= 0.99
+            if scale >= canvas_min_scale:
+                self._scale = scale
+                self._canvas_fallback = 'downscale'
+                return
+        elif oversize not in ('reject', 'downscale'):
+            raise ValueError(f"oversize must be 'reject', 'trim' or 'downscale', got {oversize!r}")
+
+        raise CanvasTooLargeError(self._get_canvas_pixels(self._last_beat), max_pixels)
+
+    def _get_bulk_end_beat(self) -> float:
+        """
+        Get the beat of the last note before the first gap of more than
+        trim_gap_bars empty bars past the middle of the chart, so that stray
+        notes far after the bulk of it are left out.
+        """
+        beats = np.sort(self._cached_arrays.beat)
+        if not len(beats):
+            return 0
+        gaps = np.flatnonzero((np.diff(beats) > trim_gap_bars * 4) & (beats[:-1] >= beats[len(beats) // 2]))
+        return beats[gaps[0]] if len(gaps) else beats[-1]
+
+    def render(self) -> Image.Image:
+        """Rasterize the chart if it has not been done yet, and return the image. Thread-safe."""
+        with self._render_lock:
+            if not self._is_rendered:
+                with self._recording_stages(), self._measure_stage('render', **self._get_total_counts()):
+                    self._render()
+                self._is_rendered = True
+        return self._im
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_render_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._render_lock = Lock()
 
     def _cache(self):
         self._cached_bpm_list = list(get_notes_for_type(self._chart, BPM))
-        self._cached_single_directional_list = list(get_notes_for_type(self._chart, (Single, Directional)))
-        self._cached_slide_list = list(get_notes_for_type(self._chart, Slide))
         self._cached_command_list = list(get_notes_for_type(self._chart, Command))
-        self._cached_duration: float = 0
-        self._cached_combo: float = 0
+        self._cached_tempo_map = TempoMap(self._cached_bpm_list)
+        self._cached_duration = self._cached_tempo_map.get_time_elapsed((self._bar_count - 1) * 4)
+        self._cached_combo = self._cached_arrays.combo_index.get_combo_before((self._bar_count - 1) * 4)
+        self._cache_beat_index()
+
+    def _cache_beat_index(self):
+        """Index every drawable object by the beats it covers, so that each window only visits the objects it shows."""
+        arrays = self._cached_arrays
+        beats = arrays.beat
+
+        skill_beats = beats[arrays.get_skill_rows()]
+        skill_times = self._cached_tempo_map.get_times_elapsed(skill_beats)
+        skills = list(zip(
+            range(len(skill_beats)), skill_beats.tolist(),
+            *(self._cached_tempo_map.get_beats_elapsed(skill_times + seconds).tolist() for seconds in (5, 7, 8))
+        ))
+
+        simultaneous_rows = arrays.get_simultaneous_rows()
+        slide_starts = np.flatnonzero((arrays.slide[:-1] >= 0) & (arrays.slide[:-1] == arrays.slide[1:]))
+
+        bpm_beats = [bpm.beat for bpm in self._cached_bpm_list]
+        self._indexed_bpm = BeatIndex(self._cached_bpm_list, bpm_beats, bpm_beats)
+        # unsorted BPM notes may put the end of a skill before its start, so index the whole span
+        self._indexed_skill = BeatIndex(skills, [min(skill[1:]) for skill in skills], [max(skill[1:]) for skill in skills])
+        self._indexed_simultaneous = BeatIndex(
+            simultaneous_rows, [beats[rows[0]] for rows in simultaneous_rows], [beats[rows[0]] for rows in simultaneous_rows]
+        )
+        self._indexed_slide = BeatIndex(
+            slide_starts,
+            np.minimum(beats[slide_starts], beats[slide_starts + 1]), np.maximum(beats[slide_starts], beats[slide_starts + 1])
+        )
+        slide_heads = beats[arrays.slide_offsets[:-1]]
+        self._indexed_slide_head = BeatIndex(slide_heads, slide_heads, slide_heads)  # only counted, see _count_in_window
+        self._placed_notes = self._get_note_placements()
+        self._placed_slide_connections = self._get_slide_connection_placements()
+
+    def _get_note_placements(self) -> SpritePlacements:
+        """Place the sprites of the singles, each with its flick top, and then the directionals, each with its arrow."""
+        arrays, codes = self._cached_arrays, note_sprite_codes
+
+        single_rows = arrays.get_rows(arrays.type_single)
+        flags = arrays.flags[single_rows]
+        is_flick = (flags & arrays.flag_flick) != 0
+        single_sprites = np.select(
+            (is_flick, (flags & arrays.flag_skill) != 0, arrays.beat[single_rows] % 0.5 != 0),
+            (codes['flick'], codes['skill'], codes['normal_16']), codes['normal']
+        )
 
-    def _render(self):
-        self.theme = BaseTheme
-        self.im = Image.new('RGBA', (self._w_single_column, self._h_single_column), self.theme.transparent_color)
-
-        self._comment_bpm_changing()
-        self._comment_bar()
-
-        self._draw_and_comment_skill()
-        self._draw_and_comment_fever()
-
-        self._draw_dividers()
-        self._draw_simultaneous_line()
-        self._draw_note_single_all()
-        self._draw_note_directional_all()
-        self._draw_slide_all()
-        self._draw_slide_connections_all()
-
-        self._post_processing_segment()
-        self._post_processing_background()
-        if self._jacket:
-            self._post_processing_song_jacket()
-        self._post_processing_song_meta()
-        self._post_processing_add_slogan()
-
-    def _locate_note(self, note: LaneLocated, offset: tuple[int, int] = (0, 0)) -> tuple[int, int]:
-        """Locate the exact position of this note on the image based on its lane value."""
-        return (
-            int(width_track_extra + width_divider + width_lane * note.lane + width_lane / 2) + offset[0],
-            get_height_from_cartesian(self._h_single_column, height_bar_extra - height_divider + height_beat * note.beat, offset[1])
+        directional_rows = arrays.get_rows(arrays.type_directional)
+        widths = arrays.width[directional_rows].astype(np.int64)
+        factors = arrays.direction[directional_rows].astype(np.int64)
+        is_left = factors < 0
+        body_rows = np.repeat(directional_rows, widths)
+        body_steps = np.arange(len(body_rows)) - np.repeat(np.cumsum(widths) - widths, widths)
+
+        return get_sprite_placements(
+            arrays,
+            (0, 0, single_rows, single_sprites, 0, 0),
+            (0, 1, single_rows[is_flick], codes['flick_top'], flick_top_offset[0], flick_top_offset[1]),
+            (1, body_steps, body_rows, np.where(np.repeat(is_left, widths), codes['flick_left'], codes['flick_right']),
+             body_steps * width_lane * np.repeat(factors, widths), 0),
+            (1, widths, directional_rows, np.where(is_left, codes['flick_left_top'], codes['flick_right_top']),
+             (widths * width_lane + flick_directional_offset_x) * factors, flick_directional_offset_y),
         )
 
-    def _locate_note_with_size(self, note: LaneLocated, note_image: Image.Image, offset: tuple[int, int] = (0, 0)) -> tuple[int, int]:
-        """Locate the exact position of this note on the image based on its lane value and the size of the note."""
-        x, y = self._locate_note(note, offset)
-        return (
-            x - note_image.width // 2,
-            y - note_image.height // 2
+    def _get_slide_connection_placements(self) -> SpritePlacements:
+        """Place the sprites of the visible slide connections, each with its flick top."""
+        arrays, codes = self._cached_arrays, note_sprite_codes
+
+        rows = np.flatnonzero((arrays.type == arrays.type_connection) & ((arrays.flags & arrays.flag_hidden) == 0))
+        flags = arrays.flags[rows]
+        is_flick = (flags & arrays.flag_flick) != 0
+        sprites = np.select(
+            (is_flick, (flags & arrays.flag_skill) != 0, arrays.get_is_endpoint()[rows]),
+            (codes['flick'], codes['skill'], codes['long']), codes['connection']
+        )
+
+        return get_sprite_placements(
+            arrays,
+            (0, 0, rows, sprites, 0, 0),
+            (0, 1, rows[is_flick], codes['flick_top'], flick_top_offset[0], flick_top_offset[1]),
         )
 
-    def _locate_slide_parallelogram(self, start: Connection, end: Connection, offset: tuple[int, int] = (0, 0)) -> list[tuple[int, int]]:
-        """Locate the exact position of the parallelogram in the image based on the lane value at the start and end of the slide."""
-        x1 = int(width_track_extra + width_lane * start.lane)
-        x2 = int(width_track_extra + width_lane * end.lane)
-        y1 = get_height_from_cartesian(self._h_single_column, height_bar_extra + height_beat * start.beat)
-        y2 = get_height_from_cartesian(self._h_single_column, height_bar_extra + height_beat * end.beat)
-        return [
-            (x1 + offset[0], y1 + offset[1]),
-            (x2 + offset[0], y2 + offset[1]),
-            (x2 + offset[0] + width_lane, y2 + offset[1]),
-            (x1 + offset[0] + width_lane, y1 + offset[1]),
-        ]
+    def render_range(self, bar_start: int, bar_end: int) -> Image.Image:
+        """
+        Render only the bars from bar_start up to, but not including, bar_end
+        into a single column on the track background, with the same notes,
+        layers and comments (cumulative combo and time included) as the full
+        image. The cost depends on the size of the range, not of the chart.
+        """
+        bar_start, bar_end = max(bar_start, 0), min(bar_end, self._bar_count)
+        if bar_start >= bar_end:
+            raise ValueError(f'no bars to render between {bar_start} and {bar_end}')
+
+        with self._render_lock:
+            im = self._im
+            try:
+                with self._recording_stages(), self._measure_stage('render_range', bars=lambda: bar_end - bar_start):
+                    im_window = self._render_window(bar_start * 4, bar_end * 4)
+            finally:
+                self._im = im
+
+        im_range = Image.new('RGBA', im_window.size, self.theme.track_background_color)
+        im_range.alpha_composite(im_window)
+        return im_range
+
+    def iter_parts(self, columns: int = 1, footer: Literal['all', 'last', 'none'] = 'last') -> Iterator[Image.Image]:
+        """
+        Render the image in parts of the given number of tiled segments, and
+        yield each part as soon as it is ready, so that only one part is in
+        memory at a time. footer tells which parts get the jacket and meta,
+        those parts are widened to width_part_footer_min if needed.
+        """
+        if columns < 1:
+            raise ValueError(f'columns must be positive, got {columns}')
+        if footer not in ('all', 'last', 'none'):
+            raise ValueError(f"footer must be 'all', 'last' or 'none', got {footer!r}")
+
+        segment_count = ceil(self._last_beat / 16)
+        for segment_start in range(0, segment_count, columns):
+            segment_end = min(segment_start + columns, segment_count)
+            with self._render_lock:
+                im = self._im
+                try:
+                    with self._recording_stages(), self._measure_stage('render_part', bars=lambda: (segment_end - segment_start) * 4):
+                        self._render_segments(segment_start, segment_end)
+                        with_footer = footer == 'all' or footer == 'last' and segment_end == segment_count
+                        if with_footer:
+                            self._widen_for_footer()
+                        self._post_processing(with_footer)
+                    im_part = self._im
+                finally:
+                    self._im = im
+            yield im_part
+
+    def iter_parts_bytes(
+            self, columns: int = 1, footer: Literal['all', 'last', 'none'] = 'last',
+            format: Optional[str] = None, preset: Optional[str] = None, **kwargs
+    ) -> Iterator[bytes]:
+        """Same as iter_parts, but yield each part encoded with the encoder options of save_image."""
+        for im_part in self.iter_parts(columns, footer):
+            io = BytesIO()
+            self._encode(im_part, io, format, preset, **kwargs)
+            yield io.getvalue()
+
+    def _render(self):
+        self._render_segments(0, ceil(self._last_beat / 16), self._scale)
+        if self._scale != 1:
+            self._widen_for_footer()
+        self._post_processing(footer=True)
+
+    def _render_segments(self, segment_start: int, segment_end: int, scale: float = 1.0):
+        """Render the chart column by column straight into the tiled segments, each column resized by scale."""
+        size_column = (round(self._w_single_column * scale), round((height_bar * 4 + height_bar_extra * 2) * scale))
+        size = (size_column[0] * (segment_end - segment_start), size_column[1])
+        im_tiled_segments = Image.new('RGBA', size, self.theme.transparent_color)
+
+        for i in range(segment_start, segment_end):
+            im_column = self._render_window(i * 16, (i + 1) * 16)
+            if scale != 1:
+                with self._measure_stage('downscale'):
+                    im_column = im_column.resize(size_column, Image.Resampling.BOX)
+            im_tiled_segments.alpha_composite(im_column, ((i - segment_start) * size_column[0], 0))
+
+        self._im = im_tiled_segments
+
+    def _widen_for_footer(self):
+        """Widen the tiled segments to width_part_footer_min, so that the song meta fits."""
+        if self._im.width < width_part_footer_min:
+            im_widened = Image.new('RGBA', (width_part_footer_min, self._im.height), self.theme.transparent_color)
+            im_widened.paste(self._im)
+            self._im = im_widened
+
+    def _post_processing(self, footer: bool):
+        with self._measure_stage('background'):
+            self._post_processing_background(footer)
+        if footer:
+            if self._jacket:
+                with self._measure_stage('song_jacket'):
+                    self._post_processing_song_jacket()
+            with self._measure_stage('song_meta'):
+                self._post_processing_song_meta()
+            with self._measure_stage('slogan'):
+                self._post_processing_add_slogan()
+
+    def _render_window(self, beat_start: int, beat_end: int) -> Image.Image:
+        """
+        Render the beats between beat_start and beat_end (with the extra area
+        on both sides) into a single column.
+
+        Every position is still calculated in the coordinate system of the
+        full-height column and then shifted by the top of the window, so the
+        result is identical to cropping the full column, which is never
+        allocated.
+        """
+        self._window = (beat_start, beat_end)
+        self._window_top = get_height_from_cartesian(self._h_single_column, height_beat * beat_end + height_bar_extra * 2)
+        size = (self._w_single_column, height_beat * (beat_end - beat_start) + height_bar_extra * 2)
+        self._im = Image.new('RGBA', size, self.theme.transparent_color)
+
+        with self._measure_stage('comment_bpm', bpm_changes=lambda: self._count_in_window(self._indexed_bpm)):
+            self._comment_bpm_changing()
+        with self._measure_stage('comment_bar', bars=self._count_bars_in_window):
+            self._comment_bar()
+
+        with self._measure_stage('skill', skills=lambda: self._count_in_window(self._indexed_skill)):
+            self._draw_and_comment_skill()
+        with self._measure_stage('fever'):
+            self._draw_and_comment_fever()
+
+        with self._measure_stage('dividers'):
+            self._draw_dividers()
+        with self._measure_stage('simultaneous_line', groups=lambda: self._count_in_window(self._indexed_simultaneous)):
+            self._draw_simultaneous_line()
+        with self._measure_stage('notes', notes=lambda: self._count_placed_in_window(self._placed_notes)):
+            self._draw_sprite_placements(self._placed_notes)
+            self._flush_sprites()
+        with self._measure_stage(
+                'slides',
+                slides=lambda: self._count_in_window(self._indexed_slide_head),
+                notes=lambda: self._count_placed_in_window(self._placed_slide_connections)
+        ):
+            self._draw_slide_all()
+            self._draw_sprite_placements(self._placed_slide_connections)
+            self._flush_sprites()
+
+        # anything outside the full column would have been cut off by its edges
+        if self._window_top < 0:
+            self._im.paste(self.theme.transparent_color, (0, 0, self._im.width, -self._window_top))
+        if self._window_top + self._im.height > self._h_single_column:
+            self._im.paste(self.theme.transparent_color, (0, self._h_single_column - self._window_top, self._im.width, self._im.height))
+
+        return self._im
+
+    @contextmanager
+    def _recording_stages(self) -> Iterator[None]:
+        """Collect the stages run inside, and send them to metrics at the end. A no-op if metrics is not set."""
+        if self.metrics is None or self._stage_recorder is not None:
+            yield
+            return
+
+        self._stage_recorder = recorder = StageRecorder()
+        try:
+            yield
+        finally:
+            self._stage_recorder = None
+        recorder.emit(self.metrics)
+
+    @contextmanager
+    def _measure_stage(self, stage: str, **counts: Callable[[], int]) -> Iterator[None]:
+        """Time a stage of the pipeline, and count its items by calling counts, only when the stages are recorded."""
+        recorder = self._stage_recorder
+        if recorder is None:
+            yield
+            return
+
+        start = perf_counter()
+        yield
+        recorder.add(stage, perf_counter() - start, self._im.size, {name: count() for name, count in counts.items()})
+
+    # the counts of each window only include the items starting in it, so that the sum over the windows is exact
+
+    def _count_in_window(self, *indexes: BeatIndex) -> int:
+        return sum(len(index.query_starting_indices(self._window)) for index in indexes)
+
+    def _count_placed_in_window(self, placements: SpritePlacements) -> int:
+        return len(np.unique(placements.rows[placements.index.query_starting_indices(self._window)]))
+
+    def _count_bars_in_window(self) -> int:
+        return sum(self._window[0] <= bar * 4 < self._window[1] for bar in get_bars_in_window(self._window, self._bar_count))
+
+    def _get_total_counts(self) -> dict[str, Callable[[], int]]:
+        """Counts of the items of the whole chart, for the metrics of a full render."""
+        return {
+            'notes': lambda: len(np.unique(self._placed_notes.rows)) + len(np.unique(self._placed_slide_connections.rows)),
+            'slides': lambda: len(np.unique(self._cached_arrays.slide[self._cached_arrays.slide >= 0])),
+            'skills': lambda: len(self._indexed_skill),
+            'bars': lambda: self._bar_count,
+        }
+
+    @contextmanager
+    def _draw_overlay(self, beat_start: float, beat_end: float) -> Iterator[ImageDraw.ImageDraw]:
+        """
+        Draw on a transparent overlay which only covers the rows of the
+        current window between the given beats (and the window margin), then
+        composite it back onto the window.
+
+        Transparent pixels leave the window untouched, so the result is the
+        same as with an overlay of the size of the whole window.
+        """
+        top = min(max(self._get_height_in_window(height_bar_extra + height_beat * (beat_end + window_margin_beat)), 0), self._im.height)
+        bottom = min(max(self._get_height_in_window(height_bar_extra + height_beat * (beat_start - window_margin_beat)), top), self._im.height)
+        im_overlay = Image.new('RGBA', (self._im.width, bottom - top), self.theme.transparent_color)
+
+        window_top = self._window_top
+        self._window_top += top  # locate everything relative to the overlay
+        try:
+            yield ImageDraw.Draw(im_overlay)
+        finally:
+            self._window_top = window_top
+
+        self._im.alpha_composite(im_overlay, (0, top))
+
+    def _get_height_in_window(self, y: float, object_height: Optional[float] = None) -> int:
+        """Convert a Cartesian height on the full column to the Pillow height in the current window."""
+        return get_height_from_cartesian(self._h_single_column, y, object_height) - self._window_top
+
+    def _locate_notes(self, rows: np.ndarray, offset_x: Any = 0, offset_y: Any = 0) -> tuple[np.ndarray, np.ndarray]:
+        """Locate the exact positions of the notes of rows in the current window based on their lane values."""
+        arrays = self._cached_arrays
+        xs = (width_track_extra + width_divider + width_lane * arrays.lane[rows] + width_lane / 2).astype(np.int64) + offset_x
+        heights = height_bar_extra - height_divider + height_beat * arrays.beat[rows]
+        return xs, (self._h_single_column - heights - offset_y).astype(np.int64) - self._window_top
+
+    def _locate_slide_edges(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Locate the left ends of the edges of the slide parallelograms at the connections of rows in the current window."""
+        arrays = self._cached_arrays
+        xs = (width_track_extra + width_lane * arrays.lane[rows]).astype(np.int64)
+        heights = height_bar_extra + height_beat * arrays.beat[rows]
+        return xs, (self._h_single_column - heights).astype(np.int64) - self._window_top
 
     def _locate_comment(self, beat: float, offset: tuple[int, int] = (0, 0)) -> tuple[int, int]:
         """Locate comment text position."""
         return (
             int(width_track_extra) + offset[0],
-            get_height_from_cartesian(self._h_single_column, height_bar_extra + height_divider + height_beat * beat + offset[1])
+            self._get_height_in_window(height_bar_extra + height_divider + height_beat * beat + offset[1])
         )
 
     def _locate_layer(self, beat_start: float, beat_end: float, offset: tuple[int, int] = (0, 0)) -> tuple[int, int, int, int]:
         """Locate layer rectangle position."""
         return (
             int(width_track_extra) + offset[0],
-            get_height_from_cartesian(self._h_single_column, height_bar_extra + height_beat * beat_end + offset[1]),
+            self._get_height_in_window(height_bar_extra + height_beat * beat_end + offset[1]),
             int(width_track_extra + width_track) + offset[0],
-            get_height_from_cartesian(self._h_single_column, height_bar_extra + height_beat * beat_start + offset[1])
+            self._get_height_in_window(height_bar_extra + height_beat * beat_start + offset[1])
         )
 
+    def _composite_on_column(self, im: Image.Image, y: int):
+        """Composite an image at the Pillow height y of the full column, if it is visible in the current window."""
+        y -= self._window_top
+        if -im.height < y < self._im.height:
+            self._im.alpha_composite(im, (0, y))
+
+    def _composite_sprite(self, im: Image.Image, dest: tuple[int, int]):
+        """Composite a note sprite onto the current window, or queue it when batching."""
+        if self._sprite_batch is None:
+            self._im.alpha_composite(im, dest)
+        else:
+            self._sprite_batch.add(im, dest)
+
+    def _flush_sprites(self):
+        """Composite the queued note sprites, before anything is drawn over them."""
+        if self._sprite_batch is not None:
+            self._sprite_batch.composite(self._im)
+
     def _calc_skill_coverage_rate(self, beat_start: float, beat_end: float) -> float:
         """Calc skill coverage rate"""
-        return get_combo_between(beat_start, beat_end, self._cached_single_directional_list, self._cached_slide_list) / self._cached_combo
+        return self._cached_arrays.combo_index.get_combo_between(beat_start, beat_end) / self._cached_combo
 
     def _comment_bpm_changing(self):
-        draw = ImageDraw.Draw(self.im)
+        draw = ImageDraw.Draw(self._im)
         font = self.theme.font_comment_bpm
 
-        for bpm in self._cached_bpm_list:
-            draw.text(
+        for bpm in self._indexed_bpm.query(self._window):
+            draw_text_stamp(
+                draw,
                 self._locate_comment(bpm.beat, (-font.size // 4, -font.size // 2)), f'{bpm.bpm} >',
                 fill=self.theme.bpm_color, anchor='rs', font=font
             )
 
     def _comment_bar(self):
-        draw = ImageDraw.Draw(self.im)
+        draw = ImageDraw.Draw(self._im)
         font = self.theme.font_comment_bar
-        bar_count = ceil(self._last_beat / 4)
 
-        for bar in range(bar_count):
-            self._cached_duration = duration = get_time_elapsed(self._cached_bpm_list, bar * 4)
-            self._cached_combo = combo = get_combo_before(bar * 4, self._cached_single_directional_list, self._cached_slide_list)
+        for bar in get_bars_in_window(self._window, self._bar_count):
+            if not is_in_window(bar * 4, bar * 4, self._window):
+                continue
+
+            duration = self._cached_tempo_map.get_time_elapsed(bar * 4)
+            combo = self._cached_arrays.combo_index.get_combo_before(bar * 4)
 
-            draw.text(self._locate_comment(bar * 4, (-5, height_bar_extra)), second_to_sexagesimal(duration),
-                      fill=self.theme.time_color, anchor='rs', font=font)  # time elapsed
-            draw.text(self._locate_comment(bar * 4, (-5, height_bar_extra * 2)), str(combo),
-                      fill=self.theme.time_color, anchor='rs', font=font)  # combo
-            draw.text(self._locate_comment(bar * 4, (-5, height_bar_extra * 3)), f'[{bar}]',
-                      fill=self.theme.time_color, anchor='rs', font=font)  # bar count
+            draw_text_stamp(draw, self._locate_comment(bar * 4, (-5, height_bar_extra)), second_to_sexagesimal(duration),
+                            fill=self.theme.time_color, anchor='rs', font=font)  # time elapsed
+            draw_text_stamp(draw, self._locate_comment(bar * 4, (-5, height_bar_extra * 2)), str(combo),
+                            fill=self.theme.time_color, anchor='rs', font=font)  # combo
+            draw_text_stamp(draw, self._locate_comment(bar * 4, (-5, height_bar_extra * 3)), f'[{bar}]',
+                            fill=self.theme.time_color, anchor='rs', font=font)  # bar count
 
     def _draw_and_comment_skill(self):
-        draw = ImageDraw.Draw(self.im)
+        draw = ImageDraw.Draw(self._im)
         font = self.theme.font_comment_skill_fever
 
-        for index, note in enumerate(get_all_skill_notes(self._chart)):
-            beat_start = note.beat
-            beat_start_time = get_time_elapsed(self._cached_bpm_list, beat_start)
-            beat_end_5 = get_beat_elapsed(self._cached_bpm_list, beat_start_time + 5)
-            beat_end_7 = get_beat_elapsed(self._cached_bpm_list, beat_start_time + 7)
-            beat_end_8 = get_beat_elapsed(self._cached_bpm_list, beat_start_time + 8)
-
+        for index, beat_start, beat_end_5, beat_end_7, beat_end_8 in self._indexed_skill.query(self._window):
             coverage_rate_5 = self._calc_skill_coverage_rate(beat_start, beat_end_5) * 100
             coverage_rate_7 = self._calc_skill_coverage_rate(beat_start, beat_end_7) * 100
             coverage_rate_8 = self._calc_skill_coverage_rate(beat_start, beat_end_8) * 100
@@ -216,202 +914,116 @@ class Render(object):
             draw.rectangle((self._locate_layer(beat_end_7, beat_end_8)),
                            fill=self.theme.skill_layer_fill_color, outline=self.theme.skill_layer_outline_color)
 
-            draw.text(self._locate_comment(beat_start, (-5, 0)), f'#{index + 1}',
-                      fill=self.theme.skill_color, anchor='rs', font=font)
-            draw.text(self._locate_comment(beat_end_5, (-5, 0)), f'#{index + 1} +5s\n{coverage_rate_5:.1f}%',
-                      fill=self.theme.skill_color, anchor='rs', font=font)
-            draw.text(self._locate_comment(beat_end_7, (-5, 0)), f'#{index + 1} +7s\n{coverage_rate_7:.1f}%',
-                      fill=self.theme.skill_color, anchor='rs', font=font)
-            draw.text(self._locate_comment(beat_end_8, (-5, 0)), f'#{index + 1} +8s\n{coverage_rate_8:.1f}%',
-                      fill=self.theme.skill_color, anchor='rs', font=font)
+            # a skill layer may span several windows, but each comment is only visible near its own beat
+            for beat, comment in (
+                    (beat_start, f'#{index + 1}'),
+                    (beat_end_5, f'#{index + 1} +5s\n{coverage_rate_5:.1f}%'),
+                    (beat_end_7, f'#{index + 1} +7s\n{coverage_rate_7:.1f}%'),
+                    (beat_end_8, f'#{index + 1} +8s\n{coverage_rate_8:.1f}%'),
+            ):
+                if is_in_window(beat, beat, self._window):
+                    draw_text_stamp(draw, self._locate_comment(beat, (-5, 0)), comment,
+                                    fill=self.theme.skill_color, anchor='rs', font=font)
 
     def _draw_and_comment_fever(self):
-        im_fever = Image.new('RGBA', (self._w_single_column, self._h_single_column), color=self.theme.transparent_color)
-        draw = ImageDraw.Draw(im_fever)
         if all(fevers := get_fever_command_tuple(self._cached_command_list)):
             fever_ready, fever_start, fever_end = fevers
         else:
             return
+        # the commands may be out of order in fan-made charts
+        beats = (fever_ready.beat, fever_start.beat, fever_end.beat)
+        if not is_in_window(min(beats), max(beats), self._window):
+            return
 
-        draw.rectangle(self._locate_layer(fever_ready.beat, fever_start.beat),
-                       fill=self.theme.fever_layer_fill_color, outline=self.theme.fever_layer_outline_color)
-        draw.rectangle(self._locate_layer(fever_start.beat, fever_end.beat),
-                       fill=self.theme.fever_layer_fill_color, outline=self.theme.fever_layer_outline_color)
-
-        draw.text(self._locate_comment(fever_ready.beat, (-5, 0)), 'Ready',
-                  fill=self.theme.fever_color, anchor='rs', font=self.theme.font_comment_skill_fever)
-        draw.text(self._locate_comment(fever_start.beat, (-5, 0)), 'Start',
-                  fill=self.theme.fever_color, anchor='rs', font=self.theme.font_comment_skill_fever)
-        draw.text(self._locate_comment(fever_end.beat, (-5, 0)), 'End',
-                  fill=self.theme.fever_color, anchor='rs', font=self.theme.font_comment_skill_fever)
+        with self._draw_overlay(min(beats), max(beats)) as draw:
+            draw.rectangle(self._locate_layer(fever_ready.beat, fever_start.beat),
+                           fill=self.theme.fever_layer_fill_color, outline=self.theme.fever_layer_outline_color)
+            draw.rectangle(self._locate_layer(fever_start.beat, fever_end.beat),
+                           fill=self.theme.fever_layer_fill_color, outline=self.theme.fever_layer_outline_color)
 
-        self.im.alpha_composite(im_fever)
+            draw_text_stamp(draw, self._locate_comment(fever_ready.beat, (-5, 0)), 'Ready',
+                            fill=self.theme.fever_color, anchor='rs', font=self.theme.font_comment_skill_fever)
+            draw_text_stamp(draw, self._locate_comment(fever_start.beat, (-5, 0)), 'Start',
+                            fill=self.theme.fever_color, anchor='rs', font=self.theme.font_comment_skill_fever)
+            draw_text_stamp(draw, self._locate_comment(fever_end.beat, (-5, 0)), 'End',
+                            fill=self.theme.fever_color, anchor='rs', font=self.theme.font_comment_skill_fever)
 
     def _draw_dividers(self):
-        im_divider = Image.new('RGBA', self.im.size, self.theme.transparent_color)
-        draw = ImageDraw.Draw(im_divider)
+        im_bar = get_bar_tile(self.theme, self._w_single_column)
+        im_bar_divider = im_bar.crop((0, 0, im_bar.width, height_divider))
+        im_lane_divider = im_bar.crop((0, height_divider, im_bar.width, height_divider + height_bar_extra))
 
-        # lane divider
-        for offset in range(8):
-            x1 = x2 = width_track_extra + offset * width_lane
-            draw.line((x1, 0, x2, self._h_single_column), fill=self.theme.divider_lane_color)
+        # extra area above the first bar (from the top), only lane dividers
+        self._composite_on_column(im_lane_divider, 0)
 
-        # beat divider
-        for offset in range(self._last_beat + 1):
-            x2 = self._w_single_column - width_track_outline - width_divider
-            y1 = y2 = height_bar_extra + offset * height_beat
-            draw.line((width_track_extra, y1, x2, y2), fill=self.theme.divider_beat_color)
+        # every bar, from the top, then the bar divider closing the last one
+        first = floor((self._window_top - height_bar_extra) / height_bar)
+        last = floor((self._window_top + self._im.height - 1 - height_bar_extra) / height_bar)
+        for offset in range(max(first, 0), min(last, self._bar_count - 1) + 1):
+            self._composite_on_column(im_bar, height_bar_extra + offset * height_bar)
+        self._composite_on_column(im_bar_divider, self._h_single_column - height_bar_extra)
 
-        # bar divider
-        for offset in range(self._last_beat // 4 + 1):
-            x1 = width_track_extra - width_track_outline
-            y1 = y2 = height_bar_extra + offset * height_bar
-            draw.line((x1, y1, self._w_single_column, y2), fill=self.theme.divider_bar_color)
-
-        self.im.alpha_composite(im_divider)
+        # extra area below the closing bar divider, only lane dividers
+        self._composite_on_column(im_lane_divider, self._h_single_column - height_bar_extra + height_divider)
 
     def _draw_simultaneous_line(self):
-        im_simultaneous_line = Image.new('RGBA', self.im.size, self.theme.transparent_color)
-        draw = ImageDraw.Draw(im_simultaneous_line)
-        offset = (0, width_simultaneous_line)
+        if not (grouped_rows := self._indexed_simultaneous.query(self._window)):
+            return
 
-        for beat, grouped_notes in get_grouped_notes_by_beat(self._chart):
-            notes = list(grouped_notes)
-            if len(notes) == 1:
-                continue
-            for note1, note2 in pairwise(notes):  # some fan-made charts have more than 2 notes in a beat (?)
-                draw.line((self._locate_note(note1, offset), self._locate_note(note2, offset)),
-                          fill=self.theme.simultaneous_line_color, width=width_simultaneous_line)
-
-        self.im.alpha_composite(im_simultaneous_line)
-
-    def _draw_note_single(self, note: Union[Single, Connection], im_note: Image.Image):
-        self.im.alpha_composite(im_note, self._locate_note_with_size(note, im_note))
-
-        if is_note_flick(note):
-            im_flick_top = open_image_resized(IGRMngr.flick_top, target_width=width_lane, back_projection=False)
-            self.im.alpha_composite(im_flick_top, self._locate_note_with_size(note, im_flick_top, flick_top_offset))
-
-    def _draw_note_single_all(self):
-        im_normal = open_image_resized(IGRMngr.normal)
-        im_flick = open_image_resized(IGRMngr.flick)
-        im_skill = open_image_resized(IGRMngr.skill)
-        im_normal_16 = open_image_resized(IGRMngr.normal_16)
-
-        for single in get_notes_for_type(self._chart, Single):
-            if is_note_flick(single):
-                im_note = im_flick
-            elif is_note_skill(single):
-                im_note = im_skill
-            elif is_note_should_black(single):
-                im_note = im_normal_16
-            else:
-                im_note = im_normal
-
-            self._draw_note_single(single, im_note)
-
-    def _draw_note_directional_all(self):
-        im_left = open_image_resized(IGRMngr.flick_left)
-        im_right = open_image_resized(IGRMngr.flick_right)
-        im_left_top = open_image_resized(IGRMngr.flick_left_top, target_width=width_lane, back_projection=False)
-        im_right_top = open_image_resized(IGRMngr.flick_right_top, target_width=width_lane, back_projection=False)
-
-        for directional in get_notes_for_type(self._chart, Directional):
-            if directional.direction == Direction.Left:
-                im_directional = im_left
-                im_directional_top = im_left_top
-                factor = -1
-            else:
-                im_directional = im_right
-                im_directional_top = im_right_top
-                factor = 1
-
-            for width in range(directional.width):
-                self.im.alpha_composite(im_directional, self._locate_note_with_size(
-                    directional, im_directional, (width * width_lane * factor, 0)
-                ))
-
-            self.im.alpha_composite(im_directional_top, self._locate_note_with_size(
-                directional, im_directional_top,
-                ((directional.width * width_lane + flick_directional_offset_x) * factor, flick_directional_offset_y)
-            ))
+        beats = self._cached_arrays.beat
+        with self._draw_overlay(beats[grouped_rows[0][0]], beats[grouped_rows[-1][0]]) as draw:
+            for rows in grouped_rows:
+                xs, ys = self._locate_notes(rows, 0, width_simultaneous_line)
+                for point1, point2 in pairwise(zip(xs.tolist(), ys.tolist())):  # some fan-made charts have more than 2 notes in a beat (?)
+                    draw.line((point1, point2), fill=self.theme.simultaneous_line_color, width=width_simultaneous_line)
 
-    def _draw_slide_all(self):
-        im_slide = Image.new('RGBA', self.im.size, self.theme.transparent_color)
-        draw = ImageDraw.Draw(im_slide)
-
-        for slide in self._cached_slide_list:
-            for start, end in pairwise(slide.connections):
-                draw.polygon(self._locate_slide_parallelogram(start, end), fill=self.theme.slide_color)
-
-        self.im.alpha_composite(im_slide)
-
-    def _draw_slide_connections_all(self):
-        im_flick = open_image_resized(IGRMngr.flick)
-        im_skill = open_image_resized(IGRMngr.skill)
-        im_long = open_image_resized(IGRMngr.long)
-        im_connection = open_image_resized(IGRMngr.connection)
-
-        for slide in self._cached_slide_list:
-            for index, connection in enumerate(slide.connections):
-                if connection.hidden:
-                    continue
-                elif is_note_flick(connection):
-                    im_note = im_flick
-                elif is_note_skill(connection):
-                    im_note = im_skill
-                elif index == 0 or index == len(slide.connections) - 1:
-                    im_note = im_long
-                else:
-                    im_note = im_connection
-                self._draw_note_single(connection, im_note)
-
-    def _post_processing_segment(self):
-        segment_count = ceil(self._last_beat / 16)
-        segment_height = height_bar * 4
-        size = (self._w_single_column * segment_count, segment_height + height_bar_extra * 2)
-        im_tiled_segments = Image.new('RGBA', size, self.theme.transparent_color)
+    def _draw_sprite_placements(self, placements: SpritePlacements):
+        sprites = [get_sprite(*arguments) for arguments in note_sprites.values()]
+        sizes = np.array([sprite.size for sprite in sprites], np.int64)
 
-        for i in range(segment_count):
-            box = (
-                0, get_height_from_cartesian(self._h_single_column, (i + 1) * segment_height + height_bar_extra * 2),
-                self._w_single_column, get_height_from_cartesian(self._h_single_column, i * segment_height)
-            )
-            im_tiled_segments.alpha_composite(self.im.crop(box), (i * self._w_single_column, 0))
+        indices = placements.index.query(self._window)
+        codes = placements.sprites[indices]
+        xs, ys = self._locate_notes(placements.rows[indices], placements.offsets_x[indices], placements.offsets_y[indices])
+        xs -= sizes[codes, 0] // 2
+        ys -= sizes[codes, 1] // 2
 
-        self.im = im_tiled_segments
+        for code, x, y in zip(codes.tolist(), xs.tolist(), ys.tolist()):
+            self._composite_sprite(sprites[code], (x, y))
 
-    def _post_processing_background(self):
-        bg_size = (
-            self.im.width + 2 * margin,
-            self.im.height + 2 * margin + 2 * margin_song_jacket + height_song_jacket
-        )
-        bg = Image.open(IGRMngr.background).convert('RGBA')
-        bg_layer = Image.new('RGBA', bg_size, self.theme.track_background_color)
-        bg = bg.crop((0, 0, bg.width, bg.height // 2)).resize(bg_size)  # crop unwanted bottom part
+    def _draw_slide_all(self):
+        if not len(starts := self._indexed_slide.query(self._window)):
+            return
 
-        draw = ImageDraw.Draw(bg_layer)
-        draw.rectangle(
-            ((0, self.im.height + 2 * margin), (bg.width, bg.height)),
-            self.theme.meta_difficulty_color[self._meta.difficulty]
-        )
+        arrays = self._cached_arrays
+        ends = starts + 1
+        with self._draw_overlay(min(arrays.beat[starts].min(), arrays.beat[ends].min()),
+                                max(arrays.beat[starts].max(), arrays.beat[ends].max())) as draw:
+            x1s, y1s = self._locate_slide_edges(starts)
+            x2s, y2s = self._locate_slide_edges(ends)
+            for x1, y1, x2, y2 in zip(x1s.tolist(), y1s.tolist(), x2s.tolist(), y2s.tolist()):
+                draw.polygon([(x1, y1), (x2, y2), (x2 + width_lane, y2), (x1 + width_lane, y1)], fill=self.theme.slide_color)
 
-        bg.alpha_composite(bg_layer, (0, 0))
-        bg.alpha_composite(self.im, (margin, margin))
+    def _post_processing_background(self, footer: bool = True):
+        bg_size = (
+            self._im.width + 2 * margin,
+            self._im.height + 2 * margin + (2 * margin_song_jacket + height_song_jacket if footer else 0)
+        )
+        bg = get_background_plate(self.theme, bg_size, footer, self._meta.difficulty).copy()
+        bg.alpha_composite(self._im, (margin, margin))
 
-        self.im = bg
+        self._im = bg
 
     def _post_processing_song_jacket(self):
         im_jacket = Image.open(self._jacket).convert('RGBA').resize((width_song_jacket, height_song_jacket))
-        self.im.paste(im_jacket, (margin_song_jacket, self.im.height - margin_song_jacket - height_song_jacket))
+        self._im.paste(im_jacket, (margin_song_jacket, self._im.height - margin_song_jacket - height_song_jacket))
 
     def _post_processing_song_meta(self):
-        draw = ImageDraw.Draw(self.im)
+        draw = ImageDraw.Draw(self._im)
         font = self.theme.font_meta
-        height_first_line = self.im.height - margin_song_jacket - height_song_jacket
+        height_first_line = self._im.height - margin_song_jacket - height_song_jacket
         width_first_key_column = width_song_jacket + 2 * margin_song_jacket
         width_first_value_column = width_first_key_column + font.getsize('Composer  ')[0]
-        width_second_key_column = self.im.width // 2
+        width_second_key_column = self._im.width // 2
         width_second_value_column = width_second_key_column + font.getsize('Duration  ')[0]
         line_spacing = font.size * 1.4
 
@@ -472,19 +1084,32 @@ class Render(object):
                   f'{self._cached_combo / self._cached_duration:.2f}', self.theme.meta_text_color, font=font)
 
     def _post_processing_add_slogan(self):
-        draw = ImageDraw.Draw(self.im)
-        draw.text((self.im.width - margin, self.im.height - margin),
+        draw = ImageDraw.Draw(self._im)
+        draw.text((self._im.width - margin, self._im.height - margin),
                   'Chart provided by bestdori.com\nGenerated by BandoriChartRender',
                   self.theme.meta_text_color, font=self.theme.font_slogan, anchor='rd')
 
-    def save(self, path: str, **kwargs) -> None:
-        self.im.save(path, **kwargs)
+    def save(self, path: Union[str, Path], format: Optional[str] = None, preset: Optional[str] = None, **kwargs) -> None:
+        """Save the image, with the encoder options of save_image. The format follows the extension if not given."""
+        self._encode(self.im, path, format, preset, **kwargs)
+
+    def _encode(self, im: Image.Image, fp: Union[str, Path, BinaryIO], format: Optional[str], preset: Optional[str], **kwargs):
+        """Encode im with save_image, timed for metrics if it is set."""
+        if self.metrics is None:
+            save_image(im, fp, format, preset, **kwargs)
+            return
+
+        start = perf_counter()
+        save_image(im, fp, format, preset, **kwargs)
+        counts = {'bytes': fp.tell()} if isinstance(fp, BytesIO) else {}
+        self.metrics(StageMetrics('encode', perf_counter() - start, im.size, counts))
 
     def show(self) -> None:
         self.im.show()
 
-    def to_bytes_io(self) -> BytesIO:
+    def to_bytes_io(self, format: Optional[str] = None, preset: Optional[str] = None, **kwargs) -> BytesIO:
+        """Encode the image, with the encoder options of save_image. PNG if no format is given."""
         io = BytesIO()
-        self.im.save(io, 'PNG')
+        self._encode(self.im, io, format, preset, **kwargs)
         io.seek(0)
         return io
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+from io import BytesIO
+from time import time
+from types import ModuleType
+from typing import Any, Callable, Optional
+
+from PIL import ImageFont
+
+from . import theme as theme_module
+from .cache import CacheBackend, CacheEntry, MemoryCache
+from .executor import RenderExecutor, render_to_bytes
+from .model import Chart, ChartMeta, DifficultyInt
+from .render import renderer_version
+from .resource import get_chart_content_official, get_song_resources_official, parse_chart_official
+from .theme import BaseTheme
+from .utils import gather_or_cancel
+
+
+def _get_fingerprint_value(value: Any) -> Any:
+    if isinstance(value, ImageFont.FreeTypeFont):
+        return value.path, value.size
+    return value
+
+
+def get_theme_fingerprint(theme: type[BaseTheme] = BaseTheme) -> str:
+    """Stable text of every theme parameter, the size configuration included."""
+    values = {
+        name: _get_fingerprint_value(value)
+        for source in (theme_module, theme)
+        for name in dir(source)
+        if not name.startswith('_')
+        for value in (getattr(source, name),)
+        if not isinstance(value, (type, ModuleType)) and not callable(value)
+    }
+    return repr(sorted(values.items()))
+
+
+def get_render_key(
+        chart: Chart, meta: ChartMeta, jacket: Optional[BytesIO] = None, theme: type[BaseTheme] = BaseTheme,
+        format: Optional[str] = None, preset: Optional[str] = None
+) -> str:
+    """Hash of everything that affects the encoded image."""
+    return get_render_key_for_content(chart.json().encode(), meta, jacket, theme, format, preset)
+
+
+def get_render_key_for_content(
+        chart_content: bytes, meta: ChartMeta, jacket: Optional[BytesIO] = None, theme: type[BaseTheme] = BaseTheme,
+        format: Optional[str] = None, preset: Optional[str] = None
+) -> str:
+    """Hash of everything that affects the encoded image, with the chart as its serialized bytes."""
+    sha256 = hashlib.sha256()
+    for part in (
+            str(renderer_version).encode(),
+            f'{format}/{preset}'.encode(),
+            get_theme_fingerprint(theme).encode(),
+            chart_content,
+            meta.json().encode(),
+            jacket.getvalue() if jacket else b'',
+    ):
+        sha256.update(hashlib.sha256(part).digest())
+    return sha256.hexdigest()
+
+
+class RenderCache(object):
+    """Encoded images of rendered charts, so that a chart seen before is neither rasterized nor encoded again."""
+
+    def __init__(self, backend: Optional[CacheBackend] = None):
+        self.backend = backend or MemoryCache()
+
+    async def render(
+            self,
+            chart: Chart,
+            meta: ChartMeta,
+            jacket: Optional[BytesIO] = None,
+            executor: Optional[RenderExecutor] = None,
+            format: Optional[str] = None,
+            preset: Optional[str] = None
+    ) -> bytes:
+        """Return the encoded image of the chart from the cache, rendering it in executor on a miss."""
+        key = get_render_key(chart, meta, jacket, format=format, preset=preset)
+        return await self._get_or_render(key, lambda: chart, meta, jacket, executor, format, preset)
+
+    async def render_official(
+            self,
+            song_id: int,
+            difficulty: DifficultyInt,
+            executor: Optional[RenderExecutor] = None,
+            format: Optional[str] = None,
+            preset: Optional[str] = None,
+            fast: bool = False
+    ) -> bytes:
+        """
+        Return the encoded image of an official chart from the cache, keyed
+        by the fetched chart bytes, so that a hit is never parsed. On a miss
+        the chart is parsed (fast=True skips validation, see
+        resource.parse_chart_fast) and rendered in executor.
+        """
+        chart_content, (meta, jacket) = await gather_or_cancel(
+            get_chart_content_official(song_id, difficulty), get_song_resources_official(song_id, difficulty)
+        )
+        key = get_render_key_for_content(chart_content, meta, jacket, format=format, preset=preset)
+        return await self._get_or_render(
+            key, lambda: parse_chart_official(chart_content, fast), meta, jacket, executor, format, preset
+        )
+
+    async def _get_or_render(
+            self,
+            key: str,
+            get_chart: Callable[[], Chart],
+            meta: ChartMeta,
+            jacket: Optional[BytesIO],
+            executor: Optional[RenderExecutor],
+            format: Optional[str],
+            preset: Optional[str]
+    ) -> bytes:
+        entry = await asyncio.to_thread(self.backend.get, key)
+        if entry is not None:
+            return entry.content
+
+        chart = get_chart()
+        if executor is not None:
+            content = await executor.submit_bytes(chart, meta, jacket, format, preset)
+        else:
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(None, render_to_bytes, chart, meta, jacket, format, preset)
+
+        await asyncio.to_thread(self.backend.set, key, CacheEntry(content, None, None, time()))
+        return content
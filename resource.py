@@ -1,19 +1,51 @@
+import asyncio
+import json
+from enum import Enum
+from functools import lru_cache
 from io import BytesIO
 from math import ceil
 from pathlib import Path
-from typing import TypeVar
+from time import time
+from typing import Any, Callable, Optional, TypeVar
 
-from pydantic import parse_obj_as
+import httpx
+from pydantic import BaseModel, parse_obj_as
 
-from .model import Chart, UserPost, BestdoriSongMeta, Bands, Language, ChartMeta, DifficultyInt
-from .utils import get_client
+from .cache import CacheBackend, CacheEntry, CacheMissError
+from .model import (
+    Chart, UserPost, BestdoriSongMeta, Bands, Language, ChartMeta, DifficultyInt,
+    NoteType, BPM, Command, Single, Directional, Slide, Connection
+)
+from .utils import gather_or_cancel, use_client
 
 difficulty_literal = ['easy', 'normal', 'hard', 'expert', 'special']
 assets = Path(__file__).parent / 'assets'
 cached_songs: dict[int, BestdoriSongMeta] = {}  # song_id: song
 cached_bands: dict[int, str] = {}  # band_id: band_name
+cache_backend: Optional[CacheBackend] = None
+cache_offline = False
+cache_ttl: dict[str, float] = {  # resource: seconds before revalidation
+    'chart_official': 7 * 24 * 3600,
+    'chart_user_post': 3600,
+    'song': 24 * 3600,
+    'bands': 24 * 3600,
+    'jacket': 30 * 24 * 3600,
+}
+note_models: dict[str, type[BaseModel]] = {
+    NoteType.BPM: BPM,
+    NoteType.System: Command,
+    NoteType.Single: Single,
+    NoteType.Directional: Directional,
+    NoteType.Slide: Slide,
+    NoteType.Long: Slide,
+}
 _T = TypeVar('_T')
 
+try:
+    import orjson
+except ImportError:  # optional, only makes parse_chart_fast faster
+    orjson = None
+
 
 class InGameResourceManager(object):
     background = assets / 'liveBG_normal.png'
@@ -37,26 +69,134 @@ class FontResourceMangaer(object):
     font_a_otf_shingopro_medium_2 = assets / 'A-OTF-ShinGoPro-Medium-2.otf'
 
 
-async def get_chart_official(song_id: int, difficulty: DifficultyInt) -> Chart:
-    async with get_client() as client:
-        response = await client.get(f'https://bestdori.com/api/charts/{song_id}/{difficulty_literal[difficulty]}.json')
+def set_cache(backend: Optional[CacheBackend], offline: bool = False):
+    """Use backend to keep downloaded resources across restarts. In offline mode only the cache is read."""
+    global cache_backend, cache_offline
+    cache_backend, cache_offline = backend, offline
+
+
+async def fetch(url: str, resource: str) -> bytes:
+    """Get the content of url, through the persistent cache if one is set."""
+    if cache_backend is None:
+        async with use_client() as client:
+            response = await client.get(url)
+            response.raise_for_status()
+        return response.content
+
+    backend = cache_backend
+    entry = await asyncio.to_thread(backend.get, url)  # the backend may block, e.g. SQLite waiting for a lock
+    if entry is not None and (cache_offline or time() - entry.stored_at < cache_ttl[resource]):
+        return entry.content
+    if cache_offline:
+        raise CacheMissError(url)
+
+    headers = {}
+    if entry is not None and entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry is not None and entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+
+    try:
+        async with use_client() as client:
+            response = await client.get(url, headers=headers)
+    except httpx.TransportError:
+        if entry is None:
+            raise
+        return entry.content  # bestdori is unreachable, serve the stale copy
+
+    if entry is not None and response.status_code == 304:
+        entry = entry._replace(stored_at=time())
+    else:
         response.raise_for_status()
-    return parse_obj_as(Chart, response.json())
+        entry = CacheEntry(response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'), time())
+
+    await asyncio.to_thread(backend.set, url, entry)
+    return entry.content
+
+
+@lru_cache(maxsize=None)
+def get_scalar_fields(model: type[BaseModel]) -> list[tuple[str, Optional[Callable[[Any], Any]], bool]]:
+    """Get (name, converter, required) of the fields of a note model, the converter is None for other than scalars."""
+    fields = []
+    for name, field in model.__fields__.items():
+        is_scalar = field.type_ in (int, float, bool, str) or isinstance(field.type_, type) and issubclass(field.type_, Enum)
+        fields.append((name, field.type_ if is_scalar else None, field.required))
+    return fields
+
+
+def construct_note(model: type[BaseModel], data: Any) -> BaseModel:
+    """Build a note without validation, only checking required fields and converting scalar values."""
+    if not isinstance(data, dict):
+        raise ValueError(f'expected a note object, got {data!r}')
+
+    values = {}
+    for name, converter, required in get_scalar_fields(model):
+        if name not in data:
+            if required:
+                raise ValueError(f'{model.__name__} note without {name}: {data!r}')
+            continue
+        value = data[name]
+        values[name] = converter(value) if converter is not None and value is not None else value
+
+    return model.construct(**values)
+
+
+def parse_chart_fast(content: bytes) -> Chart:
+    """
+    Parse a chart without pydantic validation, for trusted sources only.
+
+    Notes are built with construct() after cheap structural checks, which is
+    several times faster than parse_obj_as for big charts. orjson is used to
+    decode if it is installed.
+    """
+    notes = orjson.loads(content) if orjson is not None else json.loads(content)
+    if not isinstance(notes, list):
+        raise ValueError('expected a list of notes')
+
+    result = []
+    for note in notes:
+        model = note_models.get(note.get('type')) if isinstance(note, dict) else None
+        if model is None:
+            raise ValueError(f'unknown note {note!r}')
+
+        if model is Slide:
+            connections = note.get('connections')
+            if not isinstance(connections, list) or not connections:
+                raise ValueError(f'slide note without connections: {note!r}')
+            result.append(Slide.construct(type=note['type'], connections=[
+                construct_note(Connection, connection) for connection in connections
+            ]))
+        else:
+            result.append(construct_note(model, note))
+
+    return Chart.construct(__root__=result)
+
+
+async def get_chart_content_official(song_id: int, difficulty: DifficultyInt) -> bytes:
+    """Fetch the JSON of an official chart, without parsing it."""
+    return await fetch(f'https://bestdori.com/api/charts/{song_id}/{difficulty_literal[difficulty]}.json', 'chart_official')
+
+
+def parse_chart_official(content: bytes, fast: bool = False) -> Chart:
+    """Parse the JSON of an official chart, with fast=True by parse_chart_fast instead of being validated."""
+    if fast:
+        return parse_chart_fast(content)
+    return parse_obj_as(Chart, json.loads(content))
+
+
+async def get_chart_official(song_id: int, difficulty: DifficultyInt, fast: bool = False) -> Chart:
+    """Fetch an official chart, with fast=True it is parsed by parse_chart_fast instead of being validated."""
+    return parse_chart_official(await get_chart_content_official(song_id, difficulty), fast)
 
 
 async def get_chart_user_post(post_id: int) -> UserPost:
-    async with get_client() as client:
-        response = await client.get(f'https://bestdori.com/api/post/details?id={post_id}')
-        response.raise_for_status()
-    return UserPost(**response.json())
+    content = await fetch(f'https://bestdori.com/api/post/details?id={post_id}', 'chart_user_post')
+    return UserPost(**json.loads(content))
 
 
 async def get_song_jacket(url: str) -> BytesIO:
     try:
-        async with get_client() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-        return BytesIO(response.content)
+        return BytesIO(await fetch(url, 'jacket'))
     except Exception:  # noqa
         with open(InGameResourceManager.default_jacket, 'rb') as f:
             return BytesIO(f.read())
@@ -66,11 +206,9 @@ async def get_song_official(song_id: int) -> BestdoriSongMeta:
     if song_id in cached_songs:
         return cached_songs[song_id]
 
-    async with get_client() as client:
-        response = await client.get(f'https://bestdori.com/api/songs/{song_id}.json')
-        response.raise_for_status()
+    content = await fetch(f'https://bestdori.com/api/songs/{song_id}.json', 'song')
 
-    cached_songs.update({song_id: parse_obj_as(BestdoriSongMeta, response.json())})
+    cached_songs.update({song_id: parse_obj_as(BestdoriSongMeta, json.loads(content))})
     return cached_songs[song_id]
 
 
@@ -88,11 +226,9 @@ async def get_band_official(band_id: int) -> str:
     if band_id in cached_bands:
         return cached_bands[band_id]
 
-    async with get_client() as client:
-        response = await client.get('https://bestdori.com/api/bands/all.1.json')
-        response.raise_for_status()
+    content = await fetch('https://bestdori.com/api/bands/all.1.json', 'bands')
 
-    bands = parse_obj_as(Bands, response.json()).__root__
+    bands = parse_obj_as(Bands, json.loads(content)).__root__
     cached_bands.update({_band_id: get_valid_value_from_list(_band_name_list.bandName) for _band_id, _band_name_list in bands.items()})
     return cached_bands[band_id]
 
@@ -138,3 +274,32 @@ def generate_song_meta_user_post(post: UserPost.Post, post_id: int) -> ChartMeta
         artist=post.artists,
         chart_designer=post.author.nickname or post.author.username,
     )
+
+
+async def get_chart_resources_official(
+        song_id: int,
+        difficulty: DifficultyInt,
+        fast: bool = False
+) -> tuple[Chart, ChartMeta, BytesIO]:
+    """Fetch the chart, meta and jacket of an official chart, concurrently where possible."""
+    chart, (meta, jacket) = await gather_or_cancel(
+        get_chart_official(song_id, difficulty, fast), get_song_resources_official(song_id, difficulty)
+    )
+    return chart, meta, jacket
+
+
+async def get_song_resources_official(song_id: int, difficulty: DifficultyInt) -> tuple[ChartMeta, BytesIO]:
+    """Fetch the meta and jacket of an official chart, concurrently where possible."""
+    song = await get_song_official(song_id)
+    jacket, meta = await gather_or_cancel(
+        get_song_jacket(get_song_jacket_url_official(song_id, song.jacketImage[0])),
+        generate_song_meta_official(song, song_id, difficulty)
+    )
+    return meta, jacket
+
+
+async def get_chart_resources_user_post(post_id: int) -> tuple[Chart, ChartMeta, BytesIO]:
+    """Fetch the chart, meta and jacket of a community chart."""
+    post = (await get_chart_user_post(post_id)).post
+    jacket = await get_song_jacket(post.song.cover)
+    return post.chart, generate_song_meta_user_post(post, post_id), jacket
@@ -0,0 +1,9 @@
+import pickle
+
+from ..render import CanvasTooLargeError
+
+
+def test_canvas_too_large_error_pickle():
+    error = pickle.loads(pickle.dumps(CanvasTooLargeError(10, 5)))
+    assert (error.pixels, error.max_pixels) == (10, 5)
+    assert str(error) == 'image of 10 pixels exceeds the budget of 5 pixels'
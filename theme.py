@@ -1,4 +1,6 @@
 from abc import ABC
+from functools import lru_cache
+from pathlib import Path
 
 from PIL import ImageFont
 
@@ -15,6 +17,7 @@ width_track_outline = 7  # width of track outline (on the left side of the 0th a
 width_track_extra = 50  # width of comment area, on the left of the track, used to write bar info, bpm changes, skill note and other info
 width_note_resize = width_lane + width_divider * 8  # width of note when resizing
 width_song_jacket = height_song_jacket = 180  # width and height of song jacket (square)
+width_part_footer_min = 960  # min width of a part of the image with the song meta, when it is split into parts
 
 height_beat = 96  # height of single beat
 height_bar = height_beat * 4  # height of single bar, including 4 beats
@@ -28,6 +31,23 @@ flick_top_offset = (0, 10)
 flick_directional_offset_x, flick_directional_offset_y = (-5, 0)
 
 
+@lru_cache(maxsize=None)
+def get_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Load a font once, shared by every theme using the same path and size."""
+    return ImageFont.truetype(path, size)
+
+
+class LazyFont(object):
+    """Font of a theme, only loaded on first access."""
+
+    def __init__(self, path: Path, size: int):
+        self.path = str(path)
+        self.size = size
+
+    def __get__(self, instance, owner) -> ImageFont.FreeTypeFont:
+        return get_font(self.path, self.size)
+
+
 class BaseTheme(ABC):
     transparent_color = (255, 255, 255, 0)
     track_background_color = (0, 0, 0, 220)
@@ -58,9 +78,9 @@ class BaseTheme(ABC):
         (239, 47, 156, 190),  # special
     ]
 
-    font_comment_bpm = ImageFont.truetype(str(FontResourceMangaer.font_arial_bd), 16)
-    font_comment_bar = ImageFont.truetype(str(FontResourceMangaer.font_arial_bd), 12)
-    font_comment_skill_fever = ImageFont.truetype(str(FontResourceMangaer.font_arial_bd), 14)
-    font_meta = ImageFont.truetype(str(FontResourceMangaer.font_a_otf_shingopro_medium_2), 27)
-    font_meta_title = ImageFont.truetype(str(FontResourceMangaer.font_a_otf_shingopro_medium_2), 32)
-    font_slogan = ImageFont.truetype(str(FontResourceMangaer.font_arial_bd), 20)
+    font_comment_bpm = LazyFont(FontResourceMangaer.font_arial_bd, 16)
+    font_comment_bar = LazyFont(FontResourceMangaer.font_arial_bd, 12)
+    font_comment_skill_fever = LazyFont(FontResourceMangaer.font_arial_bd, 14)
+    font_meta = LazyFont(FontResourceMangaer.font_a_otf_shingopro_medium_2, 27)
+    font_meta_title = LazyFont(FontResourceMangaer.font_a_otf_shingopro_medium_2, 32)
+    font_slogan = LazyFont(FontResourceMangaer.font_arial_bd, 20)
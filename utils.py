@@ -1,17 +1,83 @@
-from typing import Optional
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Optional
 
 import httpx
 
+shared_client: Optional[httpx.AsyncClient] = None
 
-def get_client(proxies: Optional[str] = None, timeout: float = 15, retries: int = 0, **kwargs) -> httpx.AsyncClient:
+
+def get_client(
+        proxies: Optional[str] = None,
+        timeout: float = 15,
+        retries: int = 0,
+        limits: httpx.Limits = httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2: bool = False,
+        **kwargs
+) -> httpx.AsyncClient:
     return httpx.AsyncClient(
         proxies=proxies,
         timeout=timeout,
-        transport=httpx.AsyncHTTPTransport(retries=retries) if retries else None,
+        limits=limits,
+        http2=http2,
+        transport=httpx.AsyncHTTPTransport(retries=retries, limits=limits, http2=http2) if retries else None,
         **kwargs
     )
 
 
+async def startup_client(
+        proxies: Optional[str] = None,
+        timeout: float = 15,
+        retries: int = 0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60,
+        http2: bool = False,
+        **kwargs
+):
+    """Open the client shared by all requests, keeping connections alive until shutdown_client()."""
+    global shared_client
+    if shared_client is not None:
+        return
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry
+    )
+    shared_client = get_client(proxies, timeout, retries, limits, http2, **kwargs)
+
+
+async def shutdown_client():
+    """Close the shared client and its connections."""
+    global shared_client
+    if shared_client is not None:
+        client, shared_client = shared_client, None
+        await client.aclose()
+
+
+@asynccontextmanager
+async def use_client() -> AsyncIterator[httpx.AsyncClient]:
+    """Yield the shared client if it is open, otherwise a client for this request only."""
+    if shared_client is not None:
+        yield shared_client
+    else:
+        async with get_client() as client:
+            yield client
+
+
+async def gather_or_cancel(*aws: Awaitable[Any]) -> list[Any]:
+    """Like asyncio.gather(), but cancel the remaining awaitables as soon as one of them fails."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 def second_to_sexagesimal(t: float) -> str:
     """Convert seconds to sexagesimal notation. e.g. 0:00.0"""
     return f'{int(t // 60)}:{int(t % 60):02d}.{int(t * 10 % 10):0d}'